@@ -1,78 +1,183 @@
 import sys
-import copy
+import bisect
 import heapq
+import mmap
+import os
+import struct
+from array import array
 
 
 class Board(object):
+    '''
+    an immutable N*N board, blocks are kept row by row in a flat tuple with
+    0 as the blank
+
+    a neighbor moves a single tile, so it derives the heuristics already
+    computed on its parent instead of computing them again
+    '''
+
+    __slots__ = ('dim', 'tiles', 'blank', '_hash', '_manhattan', '_hamming',
+                 '_conflicts', '_databases', '_additive')
 
     def __init__(self, blocks):
-        self.blocks = blocks
-        self.cache = {}
+        self._init(len(blocks), tuple( n for row in blocks for n in row ))
+
+    def _init(self, dim, tiles, blank=None):
+        self.dim = dim
+        self.tiles = tiles
+        self.blank = tiles.index(0) if blank is None else blank
+        self._hash = hash(tiles)
+        self._manhattan = None
+        self._hamming = None
+        self._conflicts = None
+        self._databases = None
+        self._additive = None
+
+    @classmethod
+    def _make(cls, dim, tiles, blank=None):
+        board = cls.__new__(cls)
+        board._init(dim, tiles, blank)
+        return board
+
+    @property
+    def blocks(self):
+        dim = self.dim
+        return [ list(self.tiles[i:i+dim]) for i in range(0, dim*dim, dim) ]
 
     def dimension(self):
-        return len(self.blocks)
+        return self.dim
 
     def hamming(self):
-        dim = self.dimension()
-        dist = 0
-        for i in range(dim):
-            for j in range(dim):
-                n = i * dim + j + 1
-                if self.blocks[i][j] not in (0, n):
+        if self._hamming is None:
+            dist = 0
+            for i, n in enumerate(self.tiles):
+                if n not in (0, i + 1):
                     dist += 1
-        return dist
+            self._hamming = dist
+        return self._hamming
+
+    def _distance(self, n, i):
+        '''
+        manhattan distance of tile n at position i to its goal
+        '''
+        dim = self.dim
+        n -= 1
+        return abs(n / dim - i / dim) + abs(n % dim - i % dim)
 
     def manhattan(self):
-        key = str(self)
-        if key not in self.cache:
-            dim = self.dimension()
+        if self._manhattan is None:
             dist = 0
-            for i in range(dim):
-                for j in range(dim):
-                    n = self.blocks[i][j]
-                    if n != 0:
-                        n -= 1
-                        row = n / dim
-                        col = n % dim
-                        dist += abs(row-i) + abs(col-j)
-            self.cache[key] = dist
-        
-        return self.cache[key]
+            for i, n in enumerate(self.tiles):
+                if n != 0:
+                    dist += self._distance(n, i)
+            self._manhattan = dist
+        return self._manhattan
 
     distance = manhattan
 
+    def _line_conflicts(self, line):
+        '''
+        moves added by tiles in their goal row (line < dim) or column
+        (line - dim) but in reverse order: all but the longest increasing
+        run of them must leave the line and come back, two moves each
+        '''
+        dim = self.dim
+        if line < dim:
+            positions = range(line * dim, line * dim + dim)
+        else:
+            positions = range(line - dim, dim * dim, dim)
+
+        goals = []
+        for i in positions:
+            n = self.tiles[i] - 1
+            if n < 0:
+                continue
+            if line < dim and n / dim == line:
+                goals.append(n % dim)
+            elif line >= dim and n % dim == line - dim:
+                goals.append(n / dim)
+
+        # longest increasing subsequence
+        tails = []
+        for goal in goals:
+            k = bisect.bisect_left(tails, goal)
+            if k == len(tails):
+                tails.append(goal)
+            else:
+                tails[k] = goal
+        return 2 * (len(goals) - len(tails))
+
+    def linear_conflict(self):
+        '''
+        manhattan plus the linear conflicts of each row and column, still
+        a lower bound of the moves left but a closer one
+        '''
+        if self._conflicts is None:
+            self._conflicts = tuple( self._line_conflicts(line)
+                                     for line in range(2 * self.dim) )
+        return self.manhattan() + sum(self._conflicts)
+
     def is_goal(self):
         return self.distance() == 0
 
-    def _swap(self, p1, p2):
-        blocks = copy.deepcopy(self.blocks)
-        tmp = blocks[p1[0]][p1[1]]
-        blocks[p1[0]][p1[1]] = blocks[p2[0]][p2[1]]
-        blocks[p2[0]][p2[1]] = tmp
-        return Board(blocks)
+    def _swap(self, i, j):
+        tiles = list(self.tiles)
+        tiles[i], tiles[j] = tiles[j], tiles[i]
+        blank = self.blank
+        if blank == i:
+            blank = j
+        elif blank == j:
+            blank = i
+        return self._make(self.dim, tuple(tiles), blank)
+
+    def _move(self, i):
+        '''
+        the board with the tile at i moved to the blank, carrying the
+        heuristics known on this one
+        '''
+        dim = self.dim
+        blank = self.blank
+        n = self.tiles[i]
+        tiles = list(self.tiles)
+        tiles[blank], tiles[i] = n, 0
+        board = self._make(dim, tuple(tiles), i)
+
+        if self._manhattan is not None:
+            board._manhattan = self._manhattan + \
+                self._distance(n, blank) - self._distance(n, i)
+        if self._hamming is not None:
+            board._hamming = self._hamming + \
+                (n != blank + 1) - (n != i + 1)
+        if self._conflicts is not None:
+            # the tile keeps its place among the others of the line it moves
+            # along, only the two lines it leaves and enters change
+            if blank / dim == i / dim:
+                lines = (dim + blank % dim, dim + i % dim)
+            else:
+                lines = (blank / dim, i / dim)
+            conflicts = list(self._conflicts)
+            for line in lines:
+                conflicts[line] = board._line_conflicts(line)
+            board._conflicts = tuple(conflicts)
+        if self._additive is not None:
+            board._databases = self._databases
+            board._additive = self._databases.update(self._additive, board, n)
+        return board
 
     def neighbors(self):
-        dim = self.dimension()
-
-        blank = None
-        for i in range(dim):
-            if blank:
-                break
-            for j in range(dim):
-                if self.blocks[i][j] == 0:
-                    blank = (i, j)
-                    break
+        dim = self.dim
+        blank = self.blank
+        row, col = divmod(blank, dim)
 
         def _iter():
-            row, col = blank
             if row > 0:
-                yield self._swap(blank, (row-1, col))
+                yield self._move(blank - dim)
             if row < dim-1:
-                yield self._swap(blank, (row+1, col))
+                yield self._move(blank + dim)
             if col > 0:
-                yield self._swap(blank, (row, col-1))
+                yield self._move(blank - 1)
             if col < dim-1:
-                yield self._swap(blank, (row, col+1))
+                yield self._move(blank + 1)
 
         return _iter()
 
@@ -94,29 +199,58 @@ class Board(object):
         return Board(blocks)
 
     def __eq__(self, that):
-        return str(self) == str(that)
+        if not isinstance(that, Board):
+            return NotImplemented
+        return self.tiles == that.tiles
 
     def __ne__(self, that):
         return not self == that
 
     def __hash__(self):
-        return hash(str(self))
+        return self._hash
+
+    def inversions(self):
+        '''
+        pairs of tiles in the wrong order, the blank left aside
+        '''
+        count = 0
+        after = []
+        for n in reversed(self.tiles):
+            if n:
+                i = bisect.bisect_left(after, n)
+                count += i
+                after.insert(i, n)
+        return count
+
+    def is_solvable(self):
+        '''
+        whether the goal can be reached. With an odd dimension a move
+        changes the inversions by an even number, the goal has none, so they
+        must be even. With an even one a vertical move changes both their
+        parity and the blank's row, so their sum keeps the parity of the
+        goal's: odd
+        '''
+        inversions = self.inversions()
+        if self.dim % 2:
+            return inversions % 2 == 0
+        return (inversions + self.blank / self.dim) % 2 == 1
 
     def twin(self):
         dim = self.dimension()
         assert dim > 1
-        if self.blocks[0][0] != 0 and self.blocks[0][1] != 0:
-            return self._swap((0, 0), (0, 1))
-        return self._swap((1, 0), (1, 1))
+        if self.tiles[0] != 0 and self.tiles[1] != 0:
+            return self._swap(0, 1)
+        return self._swap(dim, dim + 1)
 
 
 class Solver(object):
 
     class Engine(object):
 
-        def __init__(self, initial):
+        def __init__(self, initial, heuristic='manhattan'):
+            self.heuristic = heuristic_of(heuristic)
             self.queue = PQ()
-            self.queue.push(initial.distance(), (initial, 0, None))
+            self.queue.push(self.heuristic(initial), (initial, 0, None))
             self.sols = {initial: None}
             self.see = set()
 
@@ -126,6 +260,9 @@ class Solver(object):
 
             #search node, moves so far, previous search node
             node, moves, prev = queue.pop()
+            # reached before by fewer moves, keep that path
+            if node in self.see:
+                return None
             self.sols[node] = prev
 
             if node.is_goal():
@@ -135,31 +272,100 @@ class Solver(object):
             moves += 1
             for neighbor in node.neighbors():
                 if neighbor != prev and neighbor not in self.see:
-                    priority = neighbor.distance() + moves
+                    priority = self.heuristic(neighbor) + moves
                     queue.push(priority, (neighbor, moves, node))
 
-    def __init__(self, initial):
+    class IDAEngine(object):
+        '''
+        iterative deepening A*: depth first searches bounded by the moves
+        so far plus the heuristic, the bound raised to the smallest value
+        beyond it after each. Memory is the current path plus a transposition
+        table of at most table_size boards
+        '''
+
+        def __init__(self, initial, heuristic='manhattan', table_size=1<<16):
+            self.heuristic = heuristic_of(heuristic)
+            self.initial = initial
+            self.table_size = table_size
+
+        def solve(self):
+            path = [self.initial]
+            bound = self.heuristic(self.initial)
+            while 1:
+                # boards reached in this iteration and their fewest moves
+                self.table = {self.initial: 0}
+                ret = self.search(path, 0, bound, None)
+                if ret is True:
+                    return len(path) - 1, path
+                bound = ret
+
+        def search(self, path, moves, bound, back):
+            '''
+            look for the goal below path[-1], reached in moves, return True
+            once found (path ends with it), else the smallest f beyond bound
+            '''
+            node = path[-1]
+            f = moves + self.heuristic(node)
+            if f > bound:
+                return f
+            if node.is_goal():
+                return True
+
+            table = self.table
+            moves += 1
+            least = float('inf')
+            for neighbor in node.neighbors():
+                # moving the blank back to where it was
+                if neighbor.blank == back:
+                    continue
+                # reached before with as few moves, already searched from
+                if table.get(neighbor, moves + 1) <= moves:
+                    continue
+                if len(table) < self.table_size:
+                    table[neighbor] = moves
+
+                path.append(neighbor)
+                ret = self.search(path, moves, bound, node.blank)
+                if ret is True:
+                    return True
+                path.pop()
+                least = min(least, ret)
+            return least
+
+    HEURISTICS = ('manhattan', 'hamming', 'linear_conflict')
+    ALGORITHMS = ('astar', 'ida')
+
+    def __init__(self, initial, heuristic='manhattan', algorithm='astar'):
+        '''
+        heuristic is the name of the Board method estimating the moves left,
+        or a function of the board such as PatternDatabases. algorithm is
+        either 'astar', or 'ida' whose memory only grows with the number of
+        moves, for boards bigger than 3x3
+        '''
+        assert callable(heuristic) or heuristic in self.HEURISTICS, heuristic
+        assert algorithm in self.ALGORITHMS, algorithm
+        self.heuristic = heuristic
+        self.algorithm = algorithm
         self._moves, self._solutions = self._solve(initial)
     
     def _solve(self, initial):
-        engine1 = self.Engine(initial)
-        twin = initial.twin()
-        engine2 = self.Engine(twin)
+        if not initial.is_solvable():
+            return -1, []
+
+        if self.algorithm == 'ida':
+            return self.IDAEngine(initial, self.heuristic).solve()
 
+        engine = self.Engine(initial, self.heuristic)
         while 1:
-            ret1 = engine1.step()
-            if ret1:
-                moves, sols, end = ret1
+            ret = engine.step()
+            if ret:
+                moves, sols, end = ret
                 path = []
                 while end:
                     path.insert(0, end)
                     end = sols[end]
                 return moves, path
 
-            ret2 = engine2.step()
-            if ret2:
-                return -1, []
-
 
     def is_solvable(self):
         return self.moves > -1
@@ -173,6 +379,261 @@ class Solver(object):
         return self._solutions
 
     
+def heuristic_of(heuristic):
+    if callable(heuristic):
+        return heuristic
+    return getattr(Board, heuristic)
+
+
+def rank(positions, n):
+    '''
+    lexicographic rank of distinct positions among the k-permutations of
+    range(n). Ranks of positions + [p] follow each other for p not in
+    positions, from rank(positions) * (n - k)
+    '''
+    r = 0
+    used = 0
+    for i, p in enumerate(positions):
+        smaller = p - bin(used & ((1 << p) - 1)).count('1')
+        r = r * (n - i) + smaller
+        used |= 1 << p
+    return r
+
+
+def unrank(r, n, k):
+    digits = []
+    for i in range(k - 1, -1, -1):
+        r, digit = divmod(r, n - i)
+        digits.append(digit)
+    free = range(n)
+    return [ free.pop(digit) for digit in reversed(digits) ]
+
+
+def permutations_count(n, k):
+    count = 1
+    for i in range(k):
+        count *= n - i
+    return count
+
+
+def write_atomic(fname, chunks):
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+    os.rename(tmp, fname)
+
+
+class PatternDatabase(object):
+    '''
+    the fewest moves of the pattern tiles to bring them home, whatever
+    the other tiles and the blank, for every placement of them. Entries are
+    bytes indexed by the rank of the positions of the tiles, after a
+    header: 'XPDB', format version, dimension, number of tiles and the tiles
+
+    the file is mapped read only, processes using the same one share a
+    single copy of it
+    '''
+
+    MAGIC = 'XPDB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBB')
+    UNKNOWN = 255
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, dim, k = self.HEADER.unpack_from(self.mm)
+        assert magic == self.MAGIC and version == self.VERSION, \
+            '%s is not a pattern database' % path
+        self.dim = dim
+        self.tiles = tuple(map(ord, self.mm[self.HEADER.size:
+                                            self.HEADER.size + k]))
+        self.offset = self.HEADER.size + k
+        assert len(self.mm) == \
+            self.offset + permutations_count(dim * dim, k), \
+            '%s is truncated' % path
+
+    def lookup(self, board):
+        tiles = board.tiles
+        r = rank([ tiles.index(n) for n in self.tiles ], self.dim * self.dim)
+        return ord(self.mm[self.offset + r])
+
+    def close(self):
+        self.mm.close()
+
+    @classmethod
+    def build(cls, dim, tiles, path, checkpoint=None):
+        '''
+        compute the database of tiles by breadth first search from the goal
+        and save it to path. The search runs over the positions of the tiles
+        and of the blank, moving the blank over another tile costs nothing,
+        over a pattern tile one move, and a placement gets the fewest moves
+        over all positions of the blank
+
+        it is saved to the checkpoint file after each distance, so that an
+        interrupted build started again with the same one resumes there.
+        The result only depends on dim and tiles
+        '''
+        n = dim * dim
+        tiles = tuple(tiles)
+        k = len(tiles)
+        assert 0 < k < n - 1 and 0 not in tiles, tiles
+
+        state = cls.resume(checkpoint, dim, tiles) if checkpoint else None
+        if state:
+            d, dist, layer = state
+        else:
+            dist = bytearray([cls.UNKNOWN]) * permutations_count(n, k + 1)
+            start = rank([ t - 1 for t in tiles ] + [n - 1], n)
+            dist[start] = 0
+            d, layer = 0, array('L', [start])
+
+        while layer:
+            following = array('L')
+            # layer grows with the states reached without moving a tile
+            i = 0
+            while i < len(layer):
+                r = layer[i]
+                i += 1
+                if dist[r] != d:
+                    continue
+                positions = unrank(r, n, k + 1)
+                blank = positions[k]
+                row, col = divmod(blank, dim)
+                for target, inside in ((blank - dim, row > 0),
+                                       (blank + dim, row < dim - 1),
+                                       (blank - 1, col > 0),
+                                       (blank + 1, col < dim - 1)):
+                    if not inside:
+                        continue
+                    moved = list(positions)
+                    moved[k] = target
+                    if target in positions:
+                        moved[positions.index(target)] = blank
+                        cost = d + 1
+                    else:
+                        cost = d
+                    s = rank(moved, n)
+                    if dist[s] > cost:
+                        dist[s] = cost
+                        (layer if cost == d else following).append(s)
+
+            d += 1
+            layer = following
+            if checkpoint:
+                cls.save_checkpoint(checkpoint, dim, tiles, d, dist, layer)
+
+        # the ranks of all positions of the blank for a placement follow
+        # each other
+        blanks = n - k
+        entries = bytearray( min(dist[i:i + blanks])
+                             for i in xrange(0, len(dist), blanks) )
+        write_atomic(path, [cls.HEADER.pack(cls.MAGIC, cls.VERSION, dim, k),
+                            bytearray(tiles), entries])
+        if checkpoint:
+            os.remove(checkpoint)
+        return cls(path)
+
+    CHECKPOINT = struct.Struct('<4sBBBBL')
+
+    @classmethod
+    def save_checkpoint(cls, path, dim, tiles, d, dist, layer):
+        header = cls.CHECKPOINT.pack(cls.MAGIC, cls.VERSION, dim, len(tiles),
+                                     d, len(layer))
+        write_atomic(path, [header, bytearray(tiles), dist, layer.tostring()])
+
+    @classmethod
+    def resume(cls, path, dim, tiles):
+        '''
+        (distance, distances, states at that distance) saved in the
+        checkpoint of the same build, None without any
+        '''
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        with fp:
+            header = fp.read(cls.CHECKPOINT.size)
+            magic, version, cdim, k, d, size = cls.CHECKPOINT.unpack(header)
+            if (magic, version, cdim) != (cls.MAGIC, cls.VERSION, dim) or \
+                    tuple(bytearray(fp.read(k))) != tiles:
+                return None
+            dist = bytearray(fp.read(permutations_count(dim * dim, k + 1)))
+            layer = array('L')
+            layer.fromstring(fp.read(size * layer.itemsize))
+        return d, dist, layer
+
+
+class PatternDatabases(object):
+    '''
+    heuristic adding up PatternDatabases of disjoint tiles: each counts the
+    moves of its own tiles only, so the sum is still a lower bound of the
+    moves left. A board moving one tile only looks up the database of that
+    tile again
+
+    for the 15 puzzle the usual 6-6-3 split is::
+
+        PatternDatabases.build(4, FIFTEEN_663, 'pdb')
+    '''
+
+    def __init__(self, databases):
+        self.databases = databases
+        self.owner = {}
+        for i, db in enumerate(databases):
+            for n in db.tiles:
+                assert n not in self.owner, 'tile %d in two patterns' % n
+                self.owner[n] = i
+
+    @classmethod
+    def load(cls, paths):
+        return cls([ PatternDatabase(path) for path in paths ])
+
+    @classmethod
+    def build(cls, dim, patterns, directory):
+        '''
+        build the databases of patterns missing in directory, each one
+        resuming from its checkpoint there
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        databases = []
+        for tiles in patterns:
+            name = os.path.join(directory, '%d-%s.pdb' % (
+                dim, '-'.join(map(str, tiles))))
+            if os.path.exists(name):
+                databases.append(PatternDatabase(name))
+            else:
+                databases.append(PatternDatabase.build(dim, tiles, name,
+                                                       name + '.checkpoint'))
+        return cls(databases)
+
+    def __call__(self, board):
+        if board._databases is not self or board._additive is None:
+            board._databases = self
+            board._additive = tuple( db.lookup(board)
+                                     for db in self.databases )
+        return sum(board._additive)
+
+    def update(self, values, board, n):
+        '''
+        the values of board whose tile n moved from those of its parent
+        '''
+        i = self.owner.get(n)
+        if i is None:
+            return values
+        values = list(values)
+        values[i] = self.databases[i].lookup(board)
+        return tuple(values)
+
+    def close(self):
+        for db in self.databases:
+            db.close()
+
+
+FIFTEEN_663 = ((1, 5, 6, 9, 10, 13), (7, 8, 11, 12, 14, 15), (2, 3, 4))
+
+
 class PQ(object):
 
     def __init__(self):
@@ -20,7 +20,8 @@ def run_tests():
             continue
         
         for fn in files:
-            if fn.startswith('test_') and fn.endswith('.py'):
+            # benchmarks run on small inputs as regular tests
+            if fn.startswith(('test_', 'bench_')) and fn.endswith('.py'):
                 fname = os.path.join(directory, fn)
                 mod = load_module(fname)
                 suite.addTest(loader.loadTestsFromModule(mod))
@@ -0,0 +1,281 @@
+'''
+throughput benchmarks of url.urlexists and url.urlgrab against a local
+HTTP server, no network needed
+
+run from the tests runner (a few hundred urls)::
+
+    python -m unittest xutil.tests.bench_url
+
+or from the command line to pick the load and save results::
+
+    python -m xutil.tests.bench_url --urls 10000 --latency 0.01 --output bench.json
+
+set URL_BENCH_OUTPUT to save the JSON results from the tests runner.
+'''
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import time
+import unittest
+
+import pycurl
+
+from xutil import url
+from xutil.tests.bench_xquery import measure_apart
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    answer /<n> with the status code codes[n % len(codes)] and a body of
+    size bytes after latency seconds, serving byte ranges if asked to, and
+    validating an ETag with a 304 if asked to
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    # one write per response, unbuffered headers stall on delayed ACKs
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.answer(False)
+
+    def do_GET(self):
+        self.answer(True)
+
+    def answer(self, send_body):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        match = re.match(r'/(\d+)', self.path)
+        n = int(match.group(1)) if match else 0
+        code = server.codes[n % len(server.codes)]
+
+        body = server.body
+        headers = []
+        if server.etag and code == 200:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            headers.append(('ETag', etag))
+            if self.headers.get('If-None-Match') == etag:
+                code, body = 304, ''
+        rng = self.headers.get('Range')
+        match = rng and server.ranges and \
+            re.match(r'bytes=(\d+)-(\d*)$', rng)
+        if match and code == 200:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(body) - 1)
+            code = 206
+            headers.append(('Content-Range',
+                            'bytes %d-%d/%d' % (start, end, len(body))))
+            body = body[start:end + 1]
+        self.send_response(code)
+        if server.ranges:
+            headers.append(('Accept-Ranges', 'bytes'))
+        headers.append(('Content-Length', str(len(body))))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, sock, latency=0, size=1024, codes=(200,),
+                 ranges=True, etag=False):
+        BaseHTTPServer.HTTPServer.__init__(self, sock.getsockname(), Handler,
+                                           bind_and_activate=False)
+        self.socket = sock
+        self.latency = latency
+        self.body = 'x' * size
+        self.codes = codes
+        self.ranges = ranges
+        self.etag = etag
+
+    def handle_error(self, request, client_address):
+        # clients closing a batch early reset their connections
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+def serve(sock, options):
+    Server(sock, **options).serve_forever()
+
+
+def start_server(**options):
+    '''
+    start a Server in another process, so that it counts neither in our
+    file descriptors nor in our memory, return (process, base url)
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    process = multiprocessing.Process(target=serve, args=(sock, options))
+    process.daemon = True
+    process.start()
+    port = sock.getsockname()[1]
+    sock.close()
+    return process, 'http://127.0.0.1:%d' % port
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class FDReporter(url.Reporter):
+    '''
+    track the peak number of open file descriptors while transfers go on
+    '''
+
+    def __init__(self):
+        self.peak = open_fds()
+
+    def progress(self):
+        fds = open_fds()
+        if fds is not None:
+            self.peak = max(self.peak, fds)
+
+
+def operations(base, count, directory):
+    '''
+    return (name, run) for each benchmarked operation, run takes a Stats
+    and a Reporter
+    '''
+    urls = [ url.URL('%s/%d' % (base, i)) for i in range(count) ]
+
+    def grab(stats, reporter):
+        pairs = [ (u, os.path.join(directory, str(i)))
+                  for i, u in enumerate(urls) ]
+        url.urlgrab(pairs, stats=stats, reporter=reporter,
+                    session=url.Session())
+
+    def exists(stats, reporter):
+        url.urlexists(urls, stats=stats, reporter=reporter,
+                      session=url.Session())
+
+    return [
+        ('urlexists', exists),
+        ('urlgrab', grab),
+        ]
+
+
+def setup():
+    return url.Stats(), FDReporter()
+
+
+def summarize(arg):
+    stats, reporter = arg
+    return {
+        'requests': stats.count,
+        'errors': stats.errors,
+        'codes': dict(stats.codes),
+        'p50': stats.percentile('total', 50),
+        'p99': stats.percentile('total', 99),
+        'peak_fds': reporter.peak,
+        }
+
+
+def run(count=1000, latency=0, size=1024, codes=(200,), ranges=True):
+    '''
+    time every operation and how much memory it takes, each in a process
+    of its own, return the results as a JSON-able dict
+    '''
+    process, base = start_server(latency=latency, size=size, codes=codes,
+                                 ranges=ranges)
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, op in operations(base, count, directory):
+            seconds, growth, result = measure_apart(
+                setup, lambda arg: op(*arg) or arg, summarize)
+            # JSON turned the codes into strings
+            result['codes'] = dict( (int(code), n) for code, n
+                                    in result['codes'].iteritems() )
+            result.update({
+                'seconds': seconds,
+                'requests_per_sec': result['requests'] / seconds
+                    if seconds else None,
+                'rss_growth_kb': growth,
+                })
+            results[name] = result
+    finally:
+        process.terminate()
+        shutil.rmtree(directory)
+
+    return {
+        'params': {'urls': count, 'latency': latency, 'size': size,
+                   'codes': list(codes), 'ranges': ranges},
+        'python': platform.python_version(),
+        'curl': pycurl.version,
+        'time': time.time(),
+        'results': results,
+        }
+
+
+def save(report, path):
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+
+class URLBenchmark(unittest.TestCase):
+
+    def test_benchmark(self):
+        report = run(count=200, size=512, codes=(200, 200, 404))
+
+        self.assertEquals(set(['urlexists', 'urlgrab']),
+                          set(report['results']))
+        for result in report['results'].values():
+            self.assertEquals(200, result['requests'])
+            self.assertEquals(0, result['errors'])
+            self.assertEquals({200: 134, 404: 66}, result['codes'])
+            self.assertTrue(result['rss_growth_kb'] >= 0)
+        output = os.environ.get('URL_BENCH_OUTPUT')
+        if output:
+            save(report, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--urls', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server waits before answering')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='bytes in each body')
+    parser.add_argument('--codes', default='200',
+                        help='status codes the server cycles through, '
+                        'comma separated')
+    parser.add_argument('--no-ranges', dest='ranges', action='store_false')
+    parser.add_argument('--output', help='save results as JSON here')
+    args = parser.parse_args()
+
+    codes = tuple( int(i) for i in args.codes.split(',') )
+    report = run(args.urls, args.latency, args.size, codes, args.ranges)
+    for name, result in sorted(report['results'].iteritems()):
+        print '%-10s %8.1f req/s p50 %8.4fs p99 %8.4fs %5s fds %10d KB' % (
+            name, result['requests_per_sec'] or 0, result['p50'] or 0,
+            result['p99'] or 0, result['peak_fds'], result['rss_growth_kb'])
+    if args.output:
+        save(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
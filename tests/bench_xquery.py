@@ -0,0 +1,249 @@
+'''
+benchmarks of XQuery and Chain operations on synthetic documents
+
+run from the tests runner (small document), alone or with the rest of the
+tests through xutil.tests.run_tests::
+
+    python -m unittest xutil.tests.bench_xquery
+
+or from the command line to pick the document shape and save results::
+
+    python -m xutil.tests.bench_xquery --size 100000 --output bench.json
+
+set XQUERY_BENCH_OUTPUT to save the JSON results from the tests runner.
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import traceback
+import unittest
+
+from lxml import etree
+
+from xutil.xquery import XQuery
+
+
+def generate(size=10000, depth=4, fanout=10, seed=0):
+    '''
+    return a synthetic XML document of at most size elements, filled
+    breadth first with fanout children per node and depth levels below the
+    root, and its number of elements
+    '''
+    rand = random.Random(seed)
+    root = etree.Element('root')
+    count = 1
+    level = [root]
+    for d in range(1, depth + 1):
+        children = []
+        for parent in level:
+            for i in range(fanout):
+                if count >= size:
+                    break
+                child = etree.SubElement(parent, 'l%d' % d,
+                                         {'class': 'c%d' % rand.randrange(10)})
+                child.text = str(count)
+                children.append(child)
+                count += 1
+        level = children
+    return etree.tostring(root), count
+
+
+def maxrss():
+    '''
+    peak resident set size of the process in KB
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def rss():
+    '''
+    return (current, peak) resident set size of the process in KB, the
+    current size is only known on Linux, elsewhere both are the peak
+    '''
+    try:
+        with open('/proc/self/status') as fp:
+            status = dict( line.split(':', 1) for line in fp )
+        return (int(status['VmRSS'].split()[0]),
+                int(status['VmHWM'].split()[0]))
+    except (IOError, KeyError):
+        peak = maxrss()
+        return peak, peak
+
+
+def reset_peak():
+    '''
+    make the peak resident set size start over from the current one, where
+    the kernel allows it
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def measure(setup, op):
+    '''
+    run op on what setup returns, return (seconds, KB the resident set grew
+    by while op ran, what op returned)
+    '''
+    arg = setup()
+    gc.collect()
+    reset_peak()
+    before, _ = rss()
+    start = time.time()
+    result = op(arg)
+    seconds = time.time() - start
+    _, peak = rss()
+    return seconds, max(peak - before, 0), result
+
+
+def measure_apart(setup, op, summarize=lambda result: None):
+    '''
+    measure() in a forked child, so that the peak of an operation is not
+    hidden by the peak of whatever the process ran before it. What op
+    returned comes back through summarize, which makes it JSON-able
+    '''
+    if not hasattr(os, 'fork'):
+        seconds, growth, result = measure(setup, op)
+        return seconds, growth, summarize(result)
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            os.close(rfd)
+            seconds, growth, result = measure(setup, op)
+            os.write(wfd, json.dumps((seconds, growth, summarize(result))))
+        except:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as fp:
+        data = fp.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark child exited with status %d' % status)
+    return tuple(json.loads(data))
+
+
+def operations(xml, depth):
+    '''
+    return (name, setup, run) for each benchmarked operation, setup builds
+    the argument of run outside of the timed section
+    '''
+    leaf = 'l%d' % depth
+    path = [ 'l%d' % d for d in range(1, depth + 1) ]
+    template = XQuery('<t><u>1</u><v/></t>')
+    shared = XQuery(xml)
+
+    def fresh():
+        return XQuery(xml)
+
+    def same():
+        return shared
+
+    def pair():
+        return XQuery(xml), XQuery(xml)
+
+    def chained(x):
+        chain = x.find(path[0])
+        for sel in path[1:]:
+            chain = chain.find(sel)
+        return len(chain)
+
+    return [
+        ('find', same, lambda x: len(x.find(leaf))),
+        ('chained_find', same, chained),
+        ('remove', fresh, lambda x: x.remove('.c3')),
+        ('append', fresh, lambda x: x.find(path[-2] if depth > 1 else leaf)
+            .append(template)),
+        ('clone', same, lambda x: x.clone()),
+        ('text', same, lambda x: x.find(leaf).text()),
+        ('eq', pair, lambda pair: pair[0] == pair[1]),
+        ('dumps', same, lambda x: x.dumps()),
+        ]
+
+
+def run(size=10000, depth=4, fanout=10, repeat=3):
+    '''
+    time every operation and how much memory it takes, each repeat in a
+    process of its own, return the results as a JSON-able dict
+    '''
+    xml, elements = generate(size, depth, fanout)
+    results = {}
+    for name, setup, op in operations(xml, depth):
+        times, growths, _ = zip(*[ measure_apart(setup, op)
+                                   for i in range(repeat) ])
+        best = min(times)
+        results[name] = {
+            'best': best,
+            'mean': sum(times) / len(times),
+            'elements_per_sec': elements / best if best else None,
+            'rss_growth_kb': max(growths),
+            }
+
+    return {
+        'params': {'size': size, 'depth': depth, 'fanout': fanout,
+                   'repeat': repeat, 'elements': elements,
+                   'bytes': len(xml)},
+        'python': platform.python_version(),
+        'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+        'time': time.time(),
+        'results': results,
+        }
+
+
+def save(report, path):
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+
+class XQueryBenchmark(unittest.TestCase):
+
+    def test_benchmark(self):
+        report = run(size=2000, depth=3, fanout=12, repeat=1)
+
+        self.assertEquals(set(['find', 'chained_find', 'remove', 'append',
+                               'clone', 'text', 'eq', 'dumps']),
+                          set(report['results']))
+        for result in report['results'].values():
+            self.assertTrue(result['rss_growth_kb'] >= 0)
+        output = os.environ.get('XQUERY_BENCH_OUTPUT')
+        if output:
+            save(report, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='save results as JSON here')
+    args = parser.parse_args()
+
+    report = run(args.size, args.depth, args.fanout, args.repeat)
+    for name, result in sorted(report['results'].iteritems()):
+        print '%-14s %10.6fs %14.0f elements/s %10d KB' % (name,
+            result['best'], result['elements_per_sec'] or 0,
+            result['rss_growth_kb'])
+    if args.output:
+        save(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+import imp
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import deque
+from cStringIO import StringIO
+
+# 8puzzle.py can't be imported by name
+puzzle = imp.load_source('puzzle', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, '8puzzle.py'))
+Board = puzzle.Board
+Solver = puzzle.Solver
+PatternDatabase = puzzle.PatternDatabase
+PatternDatabases = puzzle.PatternDatabases
+
+
+def goal(dim):
+    n = dim * dim
+    return Board._make(dim, tuple(range(1, n)) + (0,))
+
+
+def shuffled(dim, steps, rand):
+    '''
+    a solvable board, steps random moves away from the goal
+    '''
+    board = goal(dim)
+    for i in range(steps):
+        board = rand.choice(list(board.neighbors()))
+    return board
+
+
+def pattern_distances(dim, tiles):
+    '''
+    fewest moves of tiles home for each placement of them, by a plain
+    breadth first search over the boards reduced to tiles and the blank
+    '''
+    n = dim * dim
+    start = tuple( t - 1 for t in tiles ) + (n - 1,)
+    dist = {start: 0}
+    queue = deque([start])
+    while queue:
+        state = queue.popleft()
+        blank = state[-1]
+        row, col = divmod(blank, dim)
+        for target, inside in ((blank - dim, row > 0),
+                               (blank + dim, row < dim - 1),
+                               (blank - 1, col > 0),
+                               (blank + 1, col < dim - 1)):
+            if not inside:
+                continue
+            moved = list(state)
+            moved[-1] = target
+            cost = dist[state]
+            if target in state:
+                moved[state.index(target)] = blank
+                cost += 1
+            moved = tuple(moved)
+            if moved not in dist or dist[moved] > cost:
+                dist[moved] = cost
+                if cost == dist[state]:
+                    queue.appendleft(moved)
+                else:
+                    queue.append(moved)
+
+    placements = {}
+    for state, d in dist.iteritems():
+        key = state[:-1]
+        placements[key] = min(d, placements.get(key, d))
+    return placements
+
+
+def board_of(dim, tiles, positions):
+    '''
+    a board with tiles at positions, the other tiles anywhere else
+    '''
+    n = dim * dim
+    cells = [None] * n
+    for t, p in zip(tiles, positions):
+        cells[p] = t
+    others = iter( t for t in range(n) if t not in tiles )
+    return Board._make(dim, tuple( next(others) if c is None else c
+                                   for c in cells ))
+
+
+class RankTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for n, k in ((4, 2), (9, 3), (9, 4), (16, 2)):
+            count = puzzle.permutations_count(n, k)
+            for r in range(count):
+                positions = puzzle.unrank(r, n, k)
+                self.assertEquals(k, len(set(positions)))
+                self.assertEquals(r, puzzle.rank(positions, n))
+
+    def test_lexicographic(self):
+        ranks = [ puzzle.rank(p, 6) for p in itertools.permutations(range(6),
+                                                                    3) ]
+
+        self.assertEquals(range(puzzle.permutations_count(6, 3)), ranks)
+
+
+class BoardTest(unittest.TestCase):
+
+    BLOCKS = [[1, 2, 3], [4, 0, 5], [6, 7, 8]]
+
+    def test_blocks(self):
+        board = Board(self.BLOCKS)
+
+        self.assertEquals((1, 2, 3, 4, 0, 5, 6, 7, 8), board.tiles)
+        self.assertEquals(4, board.blank)
+        self.assertEquals(3, board.dimension())
+        self.assertEquals(self.BLOCKS, board.blocks)
+
+    def test_load(self):
+        board = Board(self.BLOCKS)
+
+        self.assertEquals(board, Board.load(StringIO(str(board) + '\n')))
+
+    def test_equality(self):
+        board = Board(self.BLOCKS)
+        same = Board._make(3, board.tiles)
+
+        self.assertTrue(board == same and not board != same)
+        self.assertEquals(hash(board), hash(same))
+        self.assertEquals(1, len(set([board, same])))
+        self.assertNotEquals(board, board.twin())
+
+    def test_neighbors(self):
+        board = Board(self.BLOCKS)
+        neighbors = list(board.neighbors())
+
+        self.assertEquals(4, len(neighbors))
+        for neighbor in neighbors:
+            moved = [ i for i in range(9)
+                      if neighbor.tiles[i] != board.tiles[i] ]
+            self.assertEquals(sorted([board.blank, neighbor.blank]), moved)
+            self.assertEquals(neighbor.blank, neighbor.tiles.index(0))
+            self.assertTrue(board in list(neighbor.neighbors()))
+        self.assertEquals((1, 2, 3, 4, 0, 5, 6, 7, 8), board.tiles)
+        self.assertEquals(2, len(list(goal(3).neighbors())))
+
+    def test_is_solvable_2x2(self):
+        reachable = set([goal(2)])
+        queue = [goal(2)]
+        while queue:
+            for board in queue.pop().neighbors():
+                if board not in reachable:
+                    reachable.add(board)
+                    queue.append(board)
+
+        self.assertEquals(12, len(reachable))
+        for tiles in itertools.permutations(range(4)):
+            board = Board._make(2, tiles)
+            self.assertEquals(board in reachable, board.is_solvable())
+
+    def test_is_solvable(self):
+        rand = random.Random(0)
+        for dim in (3, 4, 5):
+            for i in range(20):
+                board = shuffled(dim, rand.randrange(60), rand)
+                self.assertTrue(board.is_solvable())
+                self.assertFalse(board.twin().is_solvable())
+
+    def test_unsolvable(self):
+        solver = Solver(goal(3).twin())
+
+        self.assertFalse(solver.is_solvable())
+        self.assertEquals(-1, solver.moves)
+
+    def test_neighbors_heuristics(self):
+        rand = random.Random(1)
+        for dim in (3, 4):
+            board = shuffled(dim, 30, rand)
+            board.manhattan()
+            board.linear_conflict()
+            board.hamming()
+            for i in range(30):
+                board = rand.choice(list(board.neighbors()))
+                fresh = Board._make(dim, board.tiles)
+                self.assertEquals(fresh.manhattan(), board.manhattan())
+                self.assertEquals(fresh.hamming(), board.hamming())
+                self.assertEquals(fresh.linear_conflict(),
+                                  board.linear_conflict())
+
+
+class PatternDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as fp:
+            return fp.read()
+
+    def test_breadth_first_distances(self):
+        tiles = (1, 2, 3)
+        db = PatternDatabase.build(3, tiles, self.path('db'))
+        try:
+            for positions, d in pattern_distances(3, tiles).iteritems():
+                self.assertEquals(d, db.lookup(board_of(3, tiles, positions)))
+        finally:
+            db.close()
+
+    def test_resumed_build(self):
+        PatternDatabase.build(3, (1, 2, 3, 4), self.path('whole')).close()
+
+        save = PatternDatabase.save_checkpoint.im_func
+        saved = []
+
+        def interrupted(cls, path, dim, tiles, d, dist, layer):
+            save(cls, path, dim, tiles, d, dist, layer)
+            saved.append(d)
+            if len(saved) == 3:
+                raise KeyboardInterrupt
+
+        PatternDatabase.save_checkpoint = classmethod(interrupted)
+        try:
+            self.assertRaises(KeyboardInterrupt, PatternDatabase.build, 3,
+                              (1, 2, 3, 4), self.path('resumed'),
+                              self.path('checkpoint'))
+            PatternDatabase.save_checkpoint = classmethod(
+                lambda cls, *args: saved.append(args[3]) or save(cls, *args))
+            PatternDatabase.build(3, (1, 2, 3, 4), self.path('resumed'),
+                                  self.path('checkpoint')).close()
+        finally:
+            PatternDatabase.save_checkpoint = classmethod(save)
+
+        self.assertEquals([1, 2, 3, 4], saved[:4])
+        self.assertEquals(self.read('whole'), self.read('resumed'))
+        self.assertFalse(os.path.exists(self.path('checkpoint')))
+
+    def test_additive_lower_bound(self):
+        databases = PatternDatabases.build(3, ((1, 2, 3, 4), (5, 6, 7, 8)),
+                                           self.directory)
+        rand = random.Random(2)
+        try:
+            for i in range(20):
+                board = shuffled(3, 40, rand)
+                self.assertTrue(databases(board) <= Solver(board).moves)
+        finally:
+            databases.close()
+
+
+class SolverTest(unittest.TestCase):
+
+    def check_solution(self, board, solver):
+        path = solver.solution
+        self.assertEquals(solver.moves + 1, len(path))
+        self.assertEquals(board, path[0])
+        self.assertTrue(path[-1].is_goal())
+        for before, after in zip(path, path[1:]):
+            self.assertTrue(after in list(before.neighbors()))
+
+    def test_linear_conflict(self):
+        rand = random.Random(3)
+        for i in range(15):
+            board = shuffled(3, 60, rand)
+            expected = Solver(board).moves
+            solver = Solver(board, 'linear_conflict')
+
+            self.assertEquals(expected, solver.moves)
+            self.check_solution(board, solver)
+            self.assertTrue(board.manhattan() <= board.linear_conflict()
+                            <= expected)
+
+    def test_path_as_long_as_moves(self):
+        # reached again through a longer path before being solved
+        board = Board._make(3, (3, 4, 2, 1, 0, 6, 5, 7, 8))
+        for heuristic in ('manhattan', 'linear_conflict'):
+            self.check_solution(board, Solver(board, heuristic))
+
+    def test_ida(self):
+        rand = random.Random(3)
+        for i in range(15):
+            board = shuffled(3, 60, rand)
+            expected = Solver(board).moves
+            for heuristic in ('manhattan', 'linear_conflict'):
+                solver = Solver(board, heuristic, 'ida')
+
+                self.assertEquals(expected, solver.moves)
+                self.check_solution(board, solver)
+
+    def test_fifteen(self):
+        board = shuffled(4, 40, random.Random(4))
+        astar = Solver(board, 'linear_conflict')
+        ida = Solver(board, 'linear_conflict', 'ida')
+
+        self.assertEquals(astar.moves, ida.moves)
+        self.check_solution(board, ida)
+
+    def test_pattern_databases(self):
+        directory = tempfile.mkdtemp()
+        databases = PatternDatabases.build(3, ((1, 2, 3, 4), (5, 6, 7, 8)),
+                                           directory)
+        rand = random.Random(3)
+        try:
+            for i in range(15):
+                board = shuffled(3, 60, rand)
+                solver = Solver(board, databases, 'ida')
+                path = solver.solution
+
+                self.assertEquals(Solver(board).moves, solver.moves)
+                self.assertEquals(solver.moves + 1, len(path))
+                self.assertTrue(path[-1].is_goal())
+        finally:
+            databases.close()
+            shutil.rmtree(directory)
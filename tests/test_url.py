@@ -0,0 +1,496 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from Queue import Queue
+
+import pycurl
+
+from xutil import url
+from xutil.tests.bench_url import start_server
+
+
+class ServerTestCase(unittest.TestCase):
+    '''
+    run a bench_url.Server for the tests of the class, options are given
+    to it
+    '''
+
+    options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.process, cls.base = start_server(**cls.options)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.join()
+
+    def urls(self, count, prefix=''):
+        return [ url.URL('%s/%s%d' % (self.base, prefix, i))
+                 for i in range(count) ]
+
+
+class BatchTest(ServerTestCase):
+
+    options = {'latency': 0.01}
+
+    def test_limits(self):
+        session = url.Session()
+        port = self.base.rsplit(':', 1)[1]
+        urls = [ 'http://%s:%s/%d' % (host, port, i)
+                 for i in range(6) for host in ('127.0.0.1', 'localhost') ]
+        running, per_host = [], []
+
+        def setup(c):
+            running.append(len(batch.active) + 1)
+            per_host.append(batch.hosts[c.host] + 1)
+
+        opts = [ {pycurl.URL: u, pycurl.NOBODY: 1, 'setup': setup}
+                 for u in urls ]
+        batch = url.Batch(session, opts, concurrency=3, per_host=2)
+        done = [ c.getinfo(pycurl.EFFECTIVE_URL) for c in batch.run() ]
+        batch.close()
+
+        self.assertEquals(sorted(urls), sorted(done))
+        self.assertEquals(3, max(running))
+        self.assertEquals(2, max(per_host))
+
+    def test_grouped_by_host(self):
+        session = url.Session()
+        port = self.base.rsplit(':', 1)[1]
+        urls = [ 'http://%s:%s/%d' % (host, port, i)
+                 for host in ('127.0.0.1', 'localhost') for i in range(30) ]
+        hosts, waiting = [], []
+
+        def setup(c):
+            hosts.append(c.host)
+            waiting.append(batch.waiting_count)
+
+        opts = [ {pycurl.URL: u, pycurl.NOBODY: 1, 'setup': setup}
+                 for u in urls ]
+        batch = url.Batch(session, opts, concurrency=8, per_host=2)
+        max_waiting, url.MAX_WAITING = url.MAX_WAITING, 40
+        try:
+            done = [ c.getinfo(pycurl.EFFECTIVE_URL) for c in batch.run() ]
+        finally:
+            url.MAX_WAITING = max_waiting
+            batch.close()
+
+        self.assertEquals(sorted(urls), sorted(done))
+        # the second host starts without waiting for the first one's urls
+        self.assertEquals(set(['127.0.0.1', 'localhost']), set(hosts[:4]))
+        self.assertTrue(max(waiting) <= 40)
+
+    def test_handles_reused(self):
+        session = url.Session()
+        handles = set()
+        opts = [ {pycurl.URL: u.url, pycurl.NOBODY: 1,
+                  'setup': lambda c: handles.add(id(c))}
+                 for u in self.urls(20) ]
+        stats = session.poll(opts, concurrency=4)
+
+        self.assertEquals(20, stats.count)
+        self.assertEquals(4, len(handles))
+        self.assertEquals(4, len(session.free))
+
+    def test_nested_batches(self):
+        session = url.Session()
+        found = []
+        for u, code, elapsed in session.urlcheck(self.urls(4),
+                                                 concurrency=2):
+            exists = session.urlexists(self.urls(1, 'n%d-' % len(found)))
+            found.append((code, exists.values()))
+
+        self.assertEquals([(200, [True])] * 4, found)
+
+    def test_consecutive_batches_reuse_connections(self):
+        session = url.Session()
+        connects = []
+        opt = {pycurl.URL: self.base + '/1',
+               pycurl.NOBODY: 1,
+               'callback': lambda c: connects.append(
+                   c.getinfo(pycurl.NUM_CONNECTS)),
+               }
+        for i in range(3):
+            session.poll([opt])
+
+        self.assertEquals([1, 0, 0], connects)
+        self.assertEquals(1, len(session.multis))
+
+
+class AsyncTest(ServerTestCase):
+
+    options = {'codes': (200, 404), 'latency': 0.01}
+
+    def test_exists(self):
+        loop = url.SelectLoop()
+        urls = self.urls(6)
+        future = url.aurlexists(urls, concurrency=3, loop=loop,
+                                session=url.Session())
+        exists = loop.run_until_complete(future)
+
+        self.assertEquals(dict( (u, not i % 2) for i, u in enumerate(urls) ),
+                          exists)
+
+    def test_grab(self):
+        directory = tempfile.mkdtemp()
+        try:
+            loop = url.SelectLoop()
+            pairs = [ (u, os.path.join(directory, str(i)))
+                      for i, u in enumerate(self.urls(4)) ]
+            future = url.aurlgrab(pairs, loop=loop, session=url.Session())
+            stats = loop.run_until_complete(future)
+
+            self.assertEquals({200: 2, 404: 2}, dict(stats.codes))
+            self.assertEquals(['0', '2'], sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_concurrent_batches(self):
+        loop = url.SelectLoop()
+        session = url.Session()
+        futures = [ url.aurlexists(self.urls(4, prefix), loop=loop,
+                                   session=session)
+                    for prefix in ('a', 'b') ]
+        for future in futures:
+            loop.run_until_complete(future)
+
+        self.assertEquals([4, 4], [ len(i.result()) for i in futures ])
+
+
+class StreamTest(ServerTestCase):
+
+    options = {'codes': (200, 404), 'size': 1000}
+
+    def test_callable(self):
+        chunks = []
+        url.urlstream([(self.urls(1)[0], chunks.append)],
+                      session=url.Session())
+
+        self.assertEquals('x' * 1000, ''.join(chunks))
+
+    def test_coroutine(self):
+        def consume(out):
+            try:
+                while 1:
+                    out.append((yield))
+            except url.TransferError, e:
+                out.append(e.transfer.code)
+
+        ok, failed = [], []
+        urls = self.urls(2)
+        url.urlstream([(urls[0], consume(ok)), (urls[1], consume(failed))],
+                      session=url.Session())
+
+        self.assertEquals('x' * 1000, ''.join(ok))
+        self.assertEquals([404], failed)
+
+    def test_queue(self):
+        urls = self.urls(2)
+        queues = [ Queue(1000) for u in urls ]
+        url.urlstream(zip(urls, queues), session=url.Session())
+
+        self.assertEquals('x' * 1000,
+                          ''.join(iter(queues[0].get_nowait, None)))
+        end = queues[1].get_nowait()
+        self.assertTrue(isinstance(end, url.TransferError))
+        self.assertEquals(404, end.transfer.code)
+        self.assertTrue(queues[1].empty())
+
+    def test_paused_while_queue_full(self):
+        queue = Queue(2)
+        chunks, sizes = [], []
+
+        def drain():
+            for chunk in iter(queue.get, None):
+                sizes.append(queue.qsize())
+                chunks.append(chunk)
+                time.sleep(0.001)
+
+        consumer = threading.Thread(target=drain)
+        consumer.start()
+        url.urlstream([(self.urls(1)[0], queue)], chunk_size=100,
+                      session=url.Session())
+        consumer.join()
+
+        self.assertEquals('x' * 1000, ''.join(chunks))
+        self.assertTrue(max(sizes) <= 2)
+
+    def test_error_body_not_fed(self):
+        chunks = []
+        url.urlstream([(self.urls(2)[1], chunks.append)],
+                      session=url.Session())
+
+        self.assertEquals([], chunks)
+
+    def test_connection_error(self):
+        queue = Queue()
+        # nothing listens on the discard port
+        url.urlstream([(url.URL('http://127.0.0.1:9/'), queue)],
+                      session=url.Session())
+
+        end = queue.get_nowait()
+        self.assertTrue(isinstance(end, url.TransferError))
+        self.assertEquals(pycurl.E_COULDNT_CONNECT, end.transfer.error[0])
+
+
+class GrabTest(ServerTestCase):
+
+    options = {'codes': (200, 404, 500), 'size': 100, 'etag': True}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name)) as fp:
+            return fp.read()
+
+    def test_grab(self):
+        stats = url.urlgrab([ (u, self.path(str(i)))
+                              for i, u in enumerate(self.urls(3)) ],
+                            session=url.Session())
+
+        self.assertEquals({200: 1, 404: 1, 500: 1}, dict(stats.codes))
+        self.assertEquals('x' * 100, self.read('0'))
+        self.assertEquals(['0'], os.listdir(self.directory))
+
+    def test_error_keeps_old_file(self):
+        for name in ('1', '2'):
+            with open(self.path(name), 'w') as fp:
+                fp.write('old')
+        url.urlgrab([ (u, self.path(str(i)))
+                      for i, u in enumerate(self.urls(3)) if i ],
+                    session=url.Session())
+
+        self.assertEquals('old', self.read('1'))
+        self.assertEquals('old', self.read('2'))
+        self.assertEquals(['1', '2'], sorted(os.listdir(self.directory)))
+
+    def test_file_mode_follows_umask(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        url.urlgrab([(self.urls(1)[0], self.path('0'))],
+                    session=url.Session())
+
+        self.assertEquals(0666 & ~umask,
+                          os.stat(self.path('0')).st_mode & 0777)
+
+    def test_cache_not_modified(self):
+        cache = url.Cache(self.path('cache'))
+        session = url.Session()
+        pairs = [(self.urls(1)[0], self.path('0'))]
+        url.urlgrab(pairs, cache=cache, session=session)
+        stats = url.urlgrab(pairs, cache=cache, session=session)
+
+        self.assertEquals({304: 1}, dict(stats.codes))
+        self.assertEquals((1, 1), (cache.misses, cache.hits))
+        self.assertEquals('x' * 100, self.read('0'))
+
+    def test_cache_kept_on_error(self):
+        cache = url.Cache(self.path('cache'))
+        u = self.urls(1)[0]
+        url.urlgrab([(u, self.path('0'))], cache=cache, session=url.Session())
+        meta = cache.get(u.url)
+        # a 404 for the same file name
+        url.urlgrab([(self.urls(2)[1], self.path('0'))], cache=cache,
+                    session=url.Session())
+
+        self.assertEquals(meta['etag'], cache.get(u.url)['etag'])
+        self.assertEquals('x' * 100, self.read('0'))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entry(self, cache, name, stored, atime):
+        with open(cache.path(name), 'w') as fp:
+            json.dump({'url': name, 'etag': '"1"', 'fname': name, 'size': 1,
+                       'stored': stored, 'atime': atime}, fp)
+
+    def test_prune_by_age(self):
+        cache = url.Cache(self.directory, max_age=60)
+        now = time.time()
+        self.entry(cache, 'old', now - 120, now)
+        self.entry(cache, 'new', now - 30, now - 100)
+        cache.prune()
+
+        self.assertEquals(None, cache.get('old'))
+        self.assertNotEquals(None, cache.get('new'))
+
+    def test_prune_least_recently_used(self):
+        cache = url.Cache(self.directory, max_entries=2)
+        now = time.time()
+        for i, name in enumerate(['a', 'b', 'c']):
+            self.entry(cache, name, now, now - 10 + i)
+        cache.hit('a')
+        cache.prune()
+
+        self.assertEquals(['a', 'c'], [ i for i in 'abc' if cache.get(i) ])
+
+    def test_prune_drops_broken_entries(self):
+        cache = url.Cache(self.directory)
+        with open(cache.path('a'), 'w') as fp:
+            fp.write('{')
+        cache.prune()
+
+        self.assertEquals([], os.listdir(self.directory))
+
+
+class CheckpointTest(ServerTestCase):
+
+    options = {'codes': (200, 404)}
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_resume(self):
+        urls = [ u.url for u in self.urls(10) ]
+        first = []
+        for u, code, elapsed in url.urlcheck(urls, self.path, concurrency=2,
+                                             session=url.Session()):
+            first.append(u.url)
+            if len(first) == 3:
+                break
+        second = [ u.url for u, code, elapsed in
+                   url.urlcheck(urls + urls, self.path, concurrency=2,
+                                session=url.Session()) ]
+
+        self.assertEquals(sorted(urls), sorted(first + second))
+        checkpoint = url.Checkpoint(self.path)
+        results = dict( (u, code) for u, code, elapsed
+                        in checkpoint.results() )
+        checkpoint.close()
+        self.assertEquals(dict( (u, (200, 404)[i % 2])
+                                for i, u in enumerate(urls) ), results)
+
+    def test_commit_every(self):
+        checkpoint = url.Checkpoint(self.path, commit_every=2)
+        checkpoint.add('a', 200, 0.1)
+        checkpoint.add('b', 200, 0.1)
+        checkpoint.add('c', 200, 0.1)
+        # as if the process died here
+        other = url.Checkpoint(self.path)
+
+        self.assertEquals(['a', 'b'],
+                          sorted( i[0] for i in other.results() ))
+        other.close()
+        checkpoint.close()
+
+
+class SegmentsTest(ServerTestCase):
+
+    options = {'size': 10000}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'big')
+        self.url = self.urls(1)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def grab(self):
+        stats = url.Stats()
+        url.urlgrab([(self.url, self.fname)], segments=4,
+                    segment_threshold=1000, stats=stats,
+                    session=url.Session())
+        return stats
+
+    def test_segments(self):
+        stats = self.grab()
+
+        self.assertEquals({206: 4}, dict(stats.codes))
+        with open(self.fname) as fp:
+            self.assertEquals('x' * 10000, fp.read())
+        self.assertEquals(['big'], os.listdir(self.directory))
+
+    def test_resume(self):
+        seg = url.Segments(self.url, self.fname, 10000, 4)
+        with open(seg.part, 'r+b') as fp:
+            fp.write('y' * 2500)
+        seg.finish(0)
+        stats = self.grab()
+
+        self.assertEquals({206: 3}, dict(stats.codes))
+        with open(self.fname) as fp:
+            self.assertEquals('y' * 2500 + 'x' * 7500, fp.read())
+
+    def test_changed_size_starts_over(self):
+        seg = url.Segments(self.url, self.fname, 20000, 4)
+        seg.finish(0)
+        stats = self.grab()
+
+        self.assertEquals({206: 4}, dict(stats.codes))
+
+
+class StatsTest(unittest.TestCase):
+
+    def transfer(self, total, host='a', code=200, error=None):
+        t = url.Transfer.__new__(url.Transfer)
+        t.url, t.host, t.code, t.error, t.size = host, host, code, error, 10
+        t.namelookup = t.connect = t.appconnect = t.starttransfer = 0
+        t.total = total
+        return t
+
+    def test_counts(self):
+        stats = url.Stats()
+        stats.add(self.transfer(1))
+        stats.add(self.transfer(2, 'b', 404))
+        stats.add(self.transfer(3, 'b', 0, (7, 'refused')))
+
+        self.assertEquals((3, 1, 30), (stats.count, stats.errors, stats.bytes))
+        self.assertEquals({200: 1, 404: 1, 0: 1}, dict(stats.codes))
+        self.assertEquals(2, stats.hosts['b'].count)
+        self.assertEquals(set(['a', 'b']), set(stats.summary()['hosts']))
+
+    def test_percentiles(self):
+        stats = url.Stats()
+        self.assertEquals(None, stats.percentile('total', 50))
+
+        for i in range(1, 101):
+            stats.add(self.transfer(i))
+        self.assertEquals(51, stats.percentile('total', 50))
+        self.assertEquals(100, stats.percentile('total', 99))
+        self.assertEquals(100, stats.percentile('total', 100))
+
+    def test_max_hosts(self):
+        stats = url.Stats(max_hosts=2)
+        for host in 'abcdab':
+            stats.add(self.transfer(1, host))
+
+        self.assertEquals(set(['a', 'b', url.OTHER_HOSTS]), set(stats.hosts))
+        self.assertEquals(2, stats.hosts[url.OTHER_HOSTS].count)
+        self.assertEquals(2, stats.hosts['a'].count)
+        self.assertTrue(stats.hosts['a'].random is stats.random)
+
+    def test_reservoir(self):
+        stats = url.Stats(sample_size=500)
+        for i in range(20000):
+            stats.add(self.transfer(i))
+
+        self.assertEquals(20000, stats.count)
+        self.assertEquals(500, len(stats.sample))
+        self.assertEquals(url.HOST_SAMPLE_SIZE, len(stats.hosts['a'].sample))
+        # a uniform sample of 0..19999
+        self.assertTrue(8000 < stats.percentile('total', 50) < 12000)
+        self.assertTrue(stats.percentile('total', 90) > 16000)
@@ -1,8 +1,14 @@
+import gzip
+import os
+import tempfile
+import threading
 import unittest
+from StringIO import StringIO
 
 from lxml import etree
 
-from xutil.xquery import XQuery
+from xutil.xquery import XQuery, SelectorCache, selector_cache, map_documents, \
+    make_parser
 
 
 class ChainTest(unittest.TestCase):
@@ -34,6 +40,85 @@ class ChainTest(unittest.TestCase):
 
         self.assertEquals('4', y)
 
+    def test_find_fused(self):
+        x = XQuery('<R><a><c>1</c></a><b><c>2</c></b><a><c>3</c></a></R>')
+        y = x.find('R').find('a').find('c')
+
+        self.assertEquals(('R', 'a', 'c'), y._pending[1])
+        self.assertEquals(['1', '3'], y.text())
+
+    def test_find_fused_overlapping(self):
+        x = XQuery('<R><a><c>1</c><a><c>2</c></a></a><c>3</c></R>')
+
+        self.assertEquals(['1', '2'], x.find('a').find('c').text())
+
+    def test_find_fused_selector_groups(self):
+        x = XQuery('<R><a><c>1</c></a><b><d>2</d></b><e><c>3</c></e></R>')
+
+        self.assertEquals(['1', '2'], x.find('a, b').find('c, d').text())
+
+    def test_find_on_materialized_chain(self):
+        x = XQuery('<R><a><c>1</c></a><a><c>2</c></a></R>')
+        a = x.find('a')
+        len(a)
+
+        self.assertEquals(['1', '2'], a.find('c').text())
+
+    def test_find_on_materialized_overlapping_chain(self):
+        x = XQuery('<R><a><c>1</c><a><c>2</c></a></a><c>3</c></R>')
+        a = x.find('a')
+        len(a)
+
+        self.assertEquals(x.find('a').find('c'), a.find('c'))
+        self.assertEquals(['1', '2'], a.find('c').text())
+
+    def test_modification_keeps_other_trees_pending(self):
+        x = XQuery('<R><a>1</a></R>')
+        y = XQuery('<R><a>1</a></R>')
+        found = y.find('a')
+        x.find('a').text('2')
+
+        self.assertTrue(found._pending is not None)
+        y.remove('a')
+        self.assertTrue(found._pending is None)
+        self.assertEquals(['1'], [ i.text() for i in found ])
+
+    def test_find_then_remove(self):
+        x = XQuery('<R><a>1</a><a>2</a><b/></R>')
+        found = x.find('a')
+        x.remove('a')
+
+        self.assertEquals(2, len(found))
+        self.assertEquals(['1', '2'], found.text())
+
+    def test_find_then_append(self):
+        x = XQuery('<R><a>1</a><b/></R>')
+        found = x.find('a')
+        x.find('b').append(XQuery('<a>9</a>'))
+
+        self.assertEquals(1, len(found))
+
+    def test_find_then_text(self):
+        x = XQuery('<R><a>1</a><b><c/></b></R>')
+        found = x.find('b c')
+        x.find('b').text('')
+
+        self.assertEquals(1, len(found))
+
+    def test_dump(self):
+        x = XQuery('<R><a>1</a><b/><a><c/></a></R>')
+        fp = StringIO()
+        x.find('a').dump(fp)
+
+        self.assertEquals('<a>1</a><a><c/></a>', fp.getvalue())
+
+    def test_inner_dump(self):
+        x = XQuery('<R><a>1<b/></a><a><c/></a></R>')
+        fp = StringIO()
+        x.find('a').inner_dump(fp)
+
+        self.assertEquals('<b/><c/>', fp.getvalue())
+
     def test_find_empty(self):
         x = XQuery('<R><a>1</a><a>2</a><b>3</b></R>')
 
@@ -54,6 +139,13 @@ class ChainTest(unittest.TestCase):
 
         self.assertEquals(y, x)
 
+    def test_append_copies_template(self):
+        x = XQuery('<R><a/><a/><a/></R>')
+        x.find('a').append(XQuery('<c>1</c>'))
+        x.find('c')[0].text('2')
+
+        self.assertEquals(['2', '1', '1'], x.find('c').text())
+
     def test_empty_append(self):
         x = XQuery('<R><a>1</a><a>2</a><b>3</b></R>')
         x.find('c').append(XQuery('<d/>'))
@@ -118,6 +210,28 @@ class XQueryTest(unittest.TestCase):
 
         self.assertTrue(x == y and id(x) != id(y))
 
+    def test_clone_is_independent(self):
+        x = XQuery('<R><a>1</a></R>')
+        y = x.clone()
+        y.find('a').text('2')
+
+        self.assertEquals(XQuery('<R><a>1</a></R>'), x)
+        self.assertEquals(XQuery('<R><a>2</a></R>'), y)
+
+    def test_clone_after_modification(self):
+        x = XQuery('<R><a>1</a></R>')
+        hash(x)
+        x.find('a').text('2')
+        y = x.clone()
+
+        self.assertNotEquals(XQuery('<R><a>1</a></R>'), y)
+        self.assertEquals(XQuery('<R><a>2</a></R>'), y)
+
+    def test_clone_drops_tail(self):
+        x = XQuery('<R><a>1</a>tail</R>')
+
+        self.assertEquals('<a>1</a>', x.find('a').clone().dumps())
+
     def test_remove_child(self):
         x = XQuery('''<R><a>1</a><b><c>3</c></b></R>''')
 
@@ -148,6 +262,26 @@ class XQueryTest(unittest.TestCase):
         self.assertEquals(XQuery('<R><a>1</a><b><c>3</c></b></R>'),
                           x)
 
+    def test_dump(self):
+        x = XQuery('<R><a x="1">1</a>tail<b>&amp;</b></R>')
+        fp = StringIO()
+        x.dump(fp)
+
+        self.assertEquals(x.dumps(), fp.getvalue())
+
+    def test_inner_dumps(self):
+        x = XQuery('<R><a x="1">1</a>tail<b>&amp;</b></R>')
+
+        self.assertEquals('<a x="1">1</a>tail<b>&amp;</b>', x.inner_dumps())
+
+    def test_dump_gzip(self):
+        x = XQuery('<R><a>1</a><b/></R>')
+        fp = StringIO()
+        x.dump(fp, compress=True)
+        fp.seek(0)
+
+        self.assertEquals(x.dumps(), gzip.GzipFile(fileobj=fp).read())
+
     def test_append(self):
         x = XQuery('<R><a>1</a></R>')
 
@@ -187,6 +321,57 @@ class XQueryTest(unittest.TestCase):
 
         self.assertTrue(XQuery.is_etree_node_eq(a, b))
 
+    def test_eq_deep_tree(self):
+        def deep():
+            root = node = etree.Element('a')
+            for i in range(5000):
+                node = etree.SubElement(node, 'a')
+            node.text = '1'
+            return root
+
+        self.assertEquals(XQuery(deep()), XQuery(deep()))
+        self.assertTrue(XQuery.is_etree_node_eq(deep(), deep()))
+
+    def test_comment_not_eq_element_named_like_it(self):
+        self.assertNotEquals(XQuery(etree.Comment('x')),
+                             XQuery('<Comment>x</Comment>'))
+        self.assertNotEquals(XQuery(etree.ProcessingInstruction('p', 'x')),
+                             XQuery('<ProcessingInstruction>x'
+                                    '</ProcessingInstruction>'))
+
+    def test_not_eq_other_types(self):
+        self.assertNotEquals(XQuery('<a/>'), None)
+
+    def test_hash(self):
+        nodes = set([XQuery('<a><b/></a>'), XQuery('<a><b></b></a>'),
+                     XQuery('<a><c/></a>')])
+
+        self.assertEquals(2, len(nodes))
+        self.assertTrue(XQuery('<a><b/></a>') in nodes)
+
+    def test_chain_hash(self):
+        x = XQuery('<R><a>1</a><a>2</a></R>')
+
+        self.assertEquals(hash(XQuery('<a>1</a>')), hash(x.find('a')[0]))
+        self.assertEquals(hash(x.find('a')), hash(x.find('a')))
+
+    def test_hash_after_modification(self):
+        x = XQuery('<R><a>1</a></R>')
+        before = hash(x)
+        x.find('a').text('2')
+
+        self.assertNotEquals(before, hash(x))
+        self.assertEquals(hash(XQuery('<R><a>2</a></R>')), hash(x))
+
+    def test_hash_after_modification_of_subtree(self):
+        x = XQuery('<R><a><b>1</b></a></R>')
+        a = x.find('a')[0]
+        before = hash(x), hash(a)
+        XQuery(x.root[0][0]).text('2')
+
+        self.assertNotEquals(before, (hash(x), hash(a)))
+        self.assertEquals(hash(XQuery('<a><b>2</b></a>')), hash(a))
+
     def test_text(self):
         self.assertEquals('1234',
                           XQuery('<a>1234</a>').text())
@@ -215,5 +400,338 @@ class XQueryTest(unittest.TestCase):
                           x)
 
 
+class DiffTest(unittest.TestCase):
+
+    def check_patch(self, left, right):
+        x, y = XQuery(left), XQuery(right)
+        x.apply_patch(x.diff(y).patch)
+
+        self.assertEquals(y, x)
+
+    def test_equal(self):
+        d = XQuery('<R><a>1</a><b/></R>').diff(XQuery('<R><a>1</a><b></b></R>'))
+
+        self.assertFalse(d)
+        self.assertEquals([], d.patch)
+
+    def test_changed_text(self):
+        d = XQuery('<R><a>1</a><a>2</a></R>').diff(
+            XQuery('<R><a>1</a><a>3</a></R>'))
+
+        self.assertEquals([('/R[1]/a[2]', '2', '3')], d.changed)
+        self.assertEquals([], d.removed + d.inserted)
+
+    def test_inserted_and_removed(self):
+        d = XQuery('<R><a>1</a><b>2</b><c>3</c></R>').diff(
+            XQuery('<R><a>1</a><d><e/></d><c>3</c></R>'))
+
+        self.assertEquals([('/R[1]/b[1]', XQuery('<b>2</b>'))], d.removed)
+        self.assertEquals([('/R[1]/d[1]', XQuery('<d><e/></d>'))],
+                          d.inserted)
+
+    def test_insert_before_identical_siblings(self):
+        d = XQuery('<R><a>1</a><a>2</a></R>').diff(
+            XQuery('<R><a>0</a><a>1</a><a>2</a></R>'))
+
+        self.assertEquals([('/R[1]/a[1]', XQuery('<a>0</a>'))], d.inserted)
+        self.assertEquals([], d.removed + d.changed)
+
+    def test_insert_in_front_and_change_last(self):
+        d = XQuery('<R><i>1</i><i>2</i><i>3</i><i>4</i></R>').diff(
+            XQuery('<R><i>0</i><i>1</i><i>2</i><i>3</i><i>5</i></R>'))
+
+        self.assertEquals([('/R[1]/i[1]', XQuery('<i>0</i>'))], d.inserted)
+        self.assertEquals([('/R[1]/i[4]', '4', '5')], d.changed)
+        self.assertEquals([], d.removed)
+
+    def test_insert_in_middle_and_change_last(self):
+        d = XQuery('<R><a>1</a><b>2</b><c>3</c><d>4</d></R>').diff(
+            XQuery('<R><a>1</a><x>0</x><b>2</b><c>3</c><d>5</d></R>'))
+
+        self.assertEquals([('/R[1]/x[1]', XQuery('<x>0</x>'))], d.inserted)
+        self.assertEquals([('/R[1]/d[1]', '4', '5')], d.changed)
+        self.assertEquals([], d.removed)
+
+    def test_moved_child(self):
+        d = XQuery('<R><a>1</a><b>2</b><c>3</c></R>').diff(
+            XQuery('<R><b>2</b><c>3</c><a>1</a></R>'))
+
+        self.assertEquals([('/R[1]/a[1]', XQuery('<a>1</a>'))], d.removed)
+        self.assertEquals([('/R[1]/a[1]', XQuery('<a>1</a>'))], d.inserted)
+        self.assertEquals([], d.changed)
+
+    def test_root_tags_differ(self):
+        x = XQuery('<R/>')
+        d = x.diff(XQuery('<S/>'))
+
+        self.assertEquals([('/R[1]', XQuery('<R/>'))], d.removed)
+        self.assertEquals([('/S[1]', XQuery('<S/>'))], d.inserted)
+        self.assertEquals([], d.changed)
+        self.assertRaises(ValueError, x.apply_patch, d.patch)
+
+    def test_patch(self):
+        self.check_patch('<R><a>1</a><b><c>2</c></b></R>',
+                         '<R><a>3</a><b><c>2</c><c>4</c></b></R>')
+        self.check_patch('<R><a>1</a><a>2</a></R>',
+                         '<R><a>0</a><a>1</a><a>2</a></R>')
+        self.check_patch('<R><a><b/></a><c>1</c></R>', '<R><a>x</a></R>')
+        self.check_patch('<R><a>1</a></R>', '<R><a><b/></a><!-- c --></R>')
+        self.check_patch('<R><a>1</a><b/></R>', '<R/>')
+        self.check_patch('<R><i>1</i><i>2</i><i>3</i><i>4</i></R>',
+                         '<R><i>0</i><i>1</i><i>2</i><i>3</i><i>5</i></R>')
+        self.check_patch('<R><a>1</a><b>2</b><c><d>3</d></c><d>4</d></R>',
+                         '<R><a>1</a><x/><b>2</b><c><d>6</d></c><d>5</d></R>')
+        self.check_patch('<R><a>1</a><b>2</b><c>3</c></R>',
+                         '<R><b>2</b><c>3</c><a>1</a></R>')
+
+
+class StreamTest(unittest.TestCase):
+
+    FEED = '''<feed><meta>x</meta>
+<item><id>1</id><name>a</name></item>
+<item><id>2</id><name>b</name></item>
+<other><item><id>3</id><name>c</name></item></other>
+</feed>'''
+
+    def test_stream(self):
+        ids = [ x.find('id').text() for x in
+                XQuery.stream(StringIO(self.FEED), 'item') ]
+
+        self.assertEquals(['1', '2', '3'], ids)
+
+    def test_stream_yields_usable_nodes(self):
+        nodes = [ x.clone() for x in
+                  XQuery.stream(StringIO(self.FEED), 'other item') ]
+
+        self.assertEquals([XQuery('<item><id>3</id><name>c</name></item>')],
+                          nodes)
+
+    def test_stream_frees_processed_nodes(self):
+        xml = '<R>%s<b>%s</b></R>' % ('<a>1</a>' * 5, '<a>2</a>' * 5)
+        for x in XQuery.stream(StringIO(xml), 'a'):
+            self.assertTrue(x.root.xpath('count(preceding::*)') <= 1)
+
+    def test_stream_frees_unmatched_nodes(self):
+        xml = '<R>%s<a>1</a><c>%s<a>2</a></c></R>' % (
+            '<b><d/></b>' * 50, '<b><d/></b>' * 50)
+        for x in XQuery.stream(StringIO(xml), 'a'):
+            self.assertTrue(x.root.xpath('count(preceding::*)') <= 1)
+            self.assertTrue(len(x.root.getroottree().getroot()) <= 2)
+
+    def test_stream_combinators(self):
+        xml = '<R><a><b>1</b><c><b>2</b></c></a><b>3</b></R>'
+
+        self.assertEquals(['1'], [ x.text() for x in
+                                   XQuery.stream(StringIO(xml), 'a > b') ])
+        self.assertEquals(['1', '2'], [ x.text() for x in
+                                        XQuery.stream(StringIO(xml), 'a b') ])
+        self.assertEquals(['2', '3'], [ x.text() for x in
+                                        XQuery.stream(StringIO(xml),
+                                                      'c b, R > b') ])
+
+    def test_stream_nested_matches(self):
+        xml = '<R><a><a>1</a></a></R>'
+        dumps = [ x.dumps() for x in XQuery.stream(StringIO(xml), 'a') ]
+
+        self.assertEquals(['<a>1</a>', '<a><a>1</a></a>'], dumps)
+
+    def test_stream_prolog(self):
+        for prolog in ('<!-- c -->', '<?pi x?>',
+                       '<?xml-stylesheet href="s.xsl"?><!-- c -->'):
+            xml = '%s<R><a>1</a><a>2</a></R>' % prolog
+            texts = [ x.text() for x in XQuery.stream(StringIO(xml), 'a') ]
+
+            self.assertEquals(['1', '2'], texts)
+
+    def test_stream_any_tag(self):
+        xml = '<R><a x="1"/><b x="2"/><c/></R>'
+        tags = [ x.root.tag for x in XQuery.stream(StringIO(xml), '[x]') ]
+
+        self.assertEquals(['a', 'b'], tags)
+
+
+class IndexTest(unittest.TestCase):
+
+    XML = '''<R id="r"><a class="x y" id="a1">1</a><b k="v"><a class="y">2</a>
+<c><a>3</a></c></b><a k="w" class="x">4</a><!-- comment --></R>'''
+
+    SELECTORS = ['a', '.x', '.y', 'a.x.y', '#a1', '[k]', 'a[k="w"]',
+                 'b a', 'R > a', 'b > a', 'a:first-child', 'a + a', 'd',
+                 '*', 'a, b', 'R', 'b .y']
+
+    def test_same_results_as_scan(self):
+        x = XQuery(self.XML).build_index()
+        y = XQuery(self.XML)
+
+        for sel in self.SELECTORS:
+            self.assertEquals([ i.dumps() for i in y.find(sel) ],
+                              [ i.dumps() for i in x.find(sel) ])
+
+    def test_explain(self):
+        x = XQuery(self.XML)
+
+        self.assertEquals('scan', x.explain('a'))
+        x.build_index()
+        self.assertEquals('index', x.explain('a'))
+        self.assertEquals('index', x.explain('a[k="w"]'))
+        self.assertEquals('subtree', x.explain('b a'))
+        self.assertEquals('scan', x.explain('a + a'))
+        self.assertEquals('scan', x.explain('a, b'))
+
+    def test_modification_drops_index(self):
+        x = XQuery(self.XML).build_index()
+        x.remove('c')
+
+        self.assertEquals('scan', x.explain('a'))
+        self.assertEquals(['1', '2', '4'], x.find('a').text())
+
+        x.build_index()
+        x.find('b').append(XQuery('<a>5</a>'))
+        self.assertEquals(['1', '2', '5', '4'], x.find('a').text())
+
+    def test_other_tree_modification_keeps_index(self):
+        x = XQuery(self.XML).build_index()
+        y = XQuery(self.XML)
+        y.remove('c')
+        y.append(XQuery('<a>5</a>'))
+
+        self.assertEquals('index', x.explain('a'))
+
+    def test_removed_subtree_drops_index(self):
+        x = XQuery(self.XML)
+        b = x.find('b')[0].build_index()
+        x.remove('b')
+
+        self.assertEquals('scan', b.explain('a'))
+
+
+class ParseTest(unittest.TestCase):
+
+    XML = '<R>\n  <a>1</a>\n  <b>2</b>\n</R>'
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, self.XML)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_from_file(self):
+        self.assertEquals(XQuery(self.XML), XQuery.from_file(self.path))
+
+    def test_from_buffer(self):
+        for buf in (self.XML, bytearray(self.XML),
+                    memoryview(bytearray(self.XML)), buffer(self.XML)):
+            self.assertEquals(XQuery(self.XML), XQuery.from_buffer(buf))
+
+    def test_from_mmap(self):
+        self.assertEquals(XQuery(self.XML), XQuery.from_mmap(self.path))
+
+    def test_parser_options(self):
+        x = XQuery.from_file(self.path, remove_blank_text=True)
+
+        self.assertEquals('<R><a>1</a><b>2</b></R>', x.dumps())
+        self.assertTrue(make_parser(remove_blank_text=True) is
+                        make_parser(remove_blank_text=True))
+
+    def test_parser_per_thread(self):
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(
+            make_parser(remove_blank_text=True)))
+        thread.start()
+        thread.join()
+
+        self.assertFalse(parsers[0] is make_parser(remove_blank_text=True))
+
+    def test_html(self):
+        x = XQuery.from_buffer('<p>1<br><p>2', html=True)
+
+        self.assertEquals(['1', '2'], x.find('p').text())
+
+
+class MapDocumentsTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, '<R><a>3</a><b>4</b></R>')
+        os.close(fd)
+        self.documents = ['<R><a>1</a><a>2</a></R>', self.path,
+                          '  <R><b>5</b></R>']
+        self.expected = [(0, [['1', '2'], []]),
+                         (1, [['3'], ['4']]),
+                         (2, [[], ['5']])]
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_in_process(self):
+        self.assertEquals(self.expected,
+                          list(map_documents(self.documents, ['a', 'b'],
+                                             workers=0)))
+
+    def test_in_process_interleaved(self):
+        a = map_documents(self.documents, ['a'], workers=0)
+        b = map_documents(self.documents, ['b'], workers=0, method='dumps')
+
+        self.assertEquals((0, [['1', '2']]), next(a))
+        self.assertEquals((0, [[]]), next(b))
+        self.assertEquals((1, [['3']]), next(a))
+        self.assertEquals((1, [['<b>4</b>']]), next(b))
+
+    def test_pool(self):
+        self.assertEquals(self.expected,
+                          list(map_documents(self.documents, ['a', 'b'],
+                                             workers=2, chunksize=1)))
+
+    def test_pool_unordered_dumps(self):
+        results = map_documents(self.documents, ['a'], workers=2,
+                                ordered=False, method='dumps')
+
+        self.assertEquals([(0, [['<a>1</a>', '<a>2</a>']]),
+                           (1, [['<a>3</a>']]),
+                           (2, [[]])],
+                          sorted(results))
+
+
+class SelectorCacheTest(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = SelectorCache()
+        first = cache('a')
+        second = cache('a')
+
+        self.assertTrue(first is second)
+        self.assertEquals(1, cache.hits)
+        self.assertEquals(1, cache.misses)
+
+    def test_evict_least_recently_used(self):
+        cache = SelectorCache(maxsize=2)
+        cache('a')
+        cache('b')
+        cache('a')
+        cache('c')
+
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(2, len(cache))
+
+    def test_warm(self):
+        cache = SelectorCache().warm(['a', 'b', 'a'])
+
+        self.assertEquals(2, cache.misses)
+        self.assertEquals(0, cache.hits)
+        cache('b')
+        self.assertEquals(1, cache.hits)
+
+    def test_find_uses_cache(self):
+        x = XQuery('<R><a>1</a></R>')
+        len(x.find('a.cached-selector'))
+        hits = selector_cache.hits
+        len(x.find('a.cached-selector'))
+
+        self.assertEquals(hits + 1, selector_cache.hits)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,122 +1,1520 @@
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import random
+import select
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import urlparse
+from collections import defaultdict, deque, OrderedDict
+from Queue import Full
+
 import pycurl
 
 
 CONNECT_TIMEOUT = 10
+CONCURRENCY = 64
+# files bigger than this are downloaded in segments when asked to
+SEGMENT_THRESHOLD = 16 * 1024 * 1024
+# option dicts a Batch holds back at most while their host is at its
+# per_host limit, reading past them lets the transfers to other hosts start
+MAX_WAITING = 10000
+# how often paused transfers check whether their consumer caught up
+RESUME_INTERVAL = 0.01
+# transfers sampled by Stats for percentiles, and by each host's Stats
+SAMPLE_SIZE = 10000
+HOST_SAMPLE_SIZE = 100
+# hosts Stats keeps apart, transfers to any other host are added up under
+# OTHER_HOSTS
+MAX_HOSTS = 1000
+OTHER_HOSTS = '*'
+
+
+# all of these take an optional Stats to add their Transfers to and a
+# Reporter, nothing is printed without one
+
+
+def urlgrab(url_and_fnames, connect_timeout=CONNECT_TIMEOUT,
+            concurrency=CONCURRENCY, per_host=None, session=None, cache=None,
+            segments=1, segment_threshold=SEGMENT_THRESHOLD, stats=None,
+            reporter=None):
+    '''
+    download urls to files, return the Stats of the transfers
+    '''
+    session = session or default_session()
+    return session.urlgrab(url_and_fnames, connect_timeout, concurrency,
+                           per_host, cache, segments, segment_threshold,
+                           stats, reporter)
+
+
+def urlexists(urls, connect_timeout=CONNECT_TIMEOUT,
+              concurrency=CONCURRENCY, per_host=None, session=None,
+              stats=None, reporter=None):
+    session = session or default_session()
+    return session.urlexists(urls, connect_timeout, concurrency, per_host,
+                             stats, reporter)
+
+
+def urlcheck(urls, checkpoint=None, connect_timeout=CONNECT_TIMEOUT,
+             concurrency=CONCURRENCY, per_host=None, session=None,
+             stats=None, reporter=None):
+    '''
+    check urls as they come and yield (url, code, elapsed) as each check is
+    over, see Session.urlcheck
+    '''
+    session = session or default_session()
+    return session.urlcheck(urls, checkpoint, connect_timeout, concurrency,
+                            per_host, stats=stats, reporter=reporter)
+
+
+def poll(opts, timeout=1, concurrency=CONCURRENCY, per_host=None,
+         session=None, stats=None, reporter=None):
+    session = session or default_session()
+    return session.poll(opts, timeout, concurrency, per_host, stats,
+                        reporter)
+
+
+def urlstream(url_and_consumers, connect_timeout=CONNECT_TIMEOUT,
+              concurrency=CONCURRENCY, per_host=None, chunk_size=None,
+              session=None, stats=None, reporter=None):
+    '''
+    stream each response body into its consumer instead of a file, see Sink
+    '''
+    session = session or default_session()
+    return session.urlstream(url_and_consumers, connect_timeout, concurrency,
+                             per_host, chunk_size, stats, reporter)
+
+
+def aurlgrab(url_and_fnames, connect_timeout=CONNECT_TIMEOUT,
+             concurrency=CONCURRENCY, per_host=None, session=None, loop=None,
+             stats=None, reporter=None):
+    '''
+    urlgrab on an event loop, return a future of the Stats, done once all
+    the downloads are over
+    '''
+    session = session or default_session()
+    return session.aurlgrab(url_and_fnames, connect_timeout, concurrency,
+                            per_host, loop, stats, reporter)
+
+
+def aurlexists(urls, connect_timeout=CONNECT_TIMEOUT,
+               concurrency=CONCURRENCY, per_host=None, session=None,
+               loop=None, stats=None, reporter=None):
+    '''
+    urlexists on an event loop, return a future of the exists dict
+    '''
+    session = session or default_session()
+    return session.aurlexists(urls, connect_timeout, concurrency, per_host,
+                              loop, stats, reporter)
+
+
+def host_of(url):
+    return urlparse.urlsplit(url).hostname
+
+
+class Batch(object):
+    '''
+    feed the transfers described by an iterable of option dicts to a
+    CurlMulti of its own, taken from the Session unless one is given, with
+    at most concurrency of them (and per_host for each host) running at
+    once. Finished handles are reset and go back to the session for the
+    next transfers.
+
+    besides curl options, an option dict may hold a 'setup' function called
+    with the handle right before the transfer starts, and a 'callback'
+    function called with it once the transfer is over
+
+    a transfer paused by its write function sets c.resume to a function
+    telling when it can go on, it is checked every RESUME_INTERVAL
+
+    each transfer over is measured as c.transfer, a Transfer added to stats
+    and given to the reporter, before its callback is called
+    '''
+
+    def __init__(self, session, opts, concurrency=CONCURRENCY, per_host=None,
+                 multi=None, stats=None, reporter=None):
+        self.session = session
+        # a batch started while another one runs, e.g. from a callback or
+        # between two results of urlcheck, must not drive its transfers
+        self.own_multi = multi is None
+        self.multi = session.acquire_multi() if multi is None else multi
+        self.stats = Stats() if stats is None else stats
+        self.reporter = reporter or Reporter()
+        self.opts = iter(opts)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.exhausted = False
+        # options held back by the per host limit, by host in the order
+        # they were first held, at most MAX_WAITING of them
+        self.waiting = OrderedDict()
+        self.waiting_count = 0
+        self.hosts = defaultdict(int)
+        self.active = set()
+
+    def has_room(self, host):
+        return self.per_host is None or self.hosts[host] < self.per_host
+
+    def next_opt(self):
+        for host, queue in self.waiting.iteritems():
+            if self.has_room(host):
+                opt = queue.popleft()
+                if not queue:
+                    del self.waiting[host]
+                self.waiting_count -= 1
+                return opt
+
+        while not self.exhausted and self.waiting_count < MAX_WAITING:
+            try:
+                opt = next(self.opts)
+            except StopIteration:
+                self.exhausted = True
+                break
+            host = host_of(opt[pycurl.URL])
+            if host not in self.waiting and self.has_room(host):
+                return opt
+            self.waiting.setdefault(host, deque()).append(opt)
+            self.waiting_count += 1
+
+    def fill(self):
+        while len(self.active) < self.concurrency:
+            opt = self.next_opt()
+            if opt is None:
+                break
+            self.start(opt)
+
+    def start(self, opt):
+        c = self.session.handle()
+        c.host = host_of(opt[pycurl.URL])
+        c.callback = None
+        c.error = None
+        c.resume = None
+        for key, val in opt.iteritems():
+            if key == 'callback':
+                c.callback = val
+            elif key != 'setup':
+                c.setopt(key, val)
+        if 'setup' in opt:
+            opt['setup'](c)
+
+        self.hosts[c.host] += 1
+        self.multi.add_handle(c)
+        self.active.add(c)
+
+    def finish(self, c):
+        self.multi.remove_handle(c)
+        self.active.discard(c)
+        self.hosts[c.host] -= 1
+        if not self.hosts[c.host]:
+            del self.hosts[c.host]
+        c.transfer = Transfer(c)
+        self.stats.add(c.transfer)
+        self.reporter.transfer(c.transfer)
+        if c.callback:
+            c.callback(c)
+
+    def release(self, c):
+        self.session.release(c)
+
+    def unpause(self):
+        '''
+        resume the paused transfers that can go on, return whether some
+        are still paused
+        '''
+        paused = False
+        for c in list(self.active):
+            if c.resume is None:
+                continue
+            if c.resume():
+                # the write function may pause it again right away
+                c.resume = None
+                c.pause(pycurl.PAUSE_CONT)
+            else:
+                paused = True
+        return paused
+
+    def completed(self):
+        '''
+        yield each handle whose transfer is over once its callback was
+        called, the handle is released when the next one is requested
+        '''
+        while 1:
+            num_q, ok_list, err_list = self.multi.info_read()
+            for c, errno, errmsg in err_list:
+                c.error = (errno, errmsg)
+            for c in ok_list + [ i[0] for i in err_list ]:
+                try:
+                    self.finish(c)
+                    yield c
+                finally:
+                    self.release(c)
+            if not num_q:
+                break
+
+    def run(self, timeout=1):
+        '''
+        run all the transfers, yield each handle when its transfer is over
+        and its callback was called
+        '''
+        m = self.multi
+        self.fill()
+        while self.active:
+            paused = self.unpause()
+            while 1:
+                ret, num_handles = m.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            for c in self.completed():
+                yield c
+            self.fill()
+            self.reporter.progress()
+
+            if self.active:
+                m.select(min(timeout, RESUME_INTERVAL) if paused else timeout)
+
+    def close(self):
+        '''
+        call the callbacks of unfinished transfers, give their handles
+        back to the session and hand the stats to the reporter
+        '''
+        try:
+            for c in list(self.active):
+                if c.error is None:
+                    c.error = (pycurl.E_ABORTED_BY_CALLBACK, 'batch closed')
+                try:
+                    self.finish(c)
+                finally:
+                    self.release(c)
+        finally:
+            if self.own_multi:
+                self.own_multi = False
+                self.session.release_multi(self.multi)
+            self.reporter.done(self.stats)
+
+
+class Transfer(object):
+    '''
+    measures of a transfer taken from its handle once it is over: the
+    timings in seconds since it started (DNS lookup, TCP connect, TLS
+    handshake, first byte and total), bytes received and average speed
+    '''
+
+    def __init__(self, c):
+        self.url = c.getinfo(pycurl.EFFECTIVE_URL)
+        self.host = c.host
+        self.code = c.getinfo(pycurl.HTTP_CODE)
+        self.error = c.error
+        self.namelookup = c.getinfo(pycurl.NAMELOOKUP_TIME)
+        self.connect = c.getinfo(pycurl.CONNECT_TIME)
+        self.appconnect = c.getinfo(pycurl.APPCONNECT_TIME)
+        self.starttransfer = c.getinfo(pycurl.STARTTRANSFER_TIME)
+        self.total = c.getinfo(pycurl.TOTAL_TIME)
+        self.size = int(c.getinfo(pycurl.SIZE_DOWNLOAD))
+        self.speed = c.getinfo(pycurl.SPEED_DOWNLOAD)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return '<Transfer %s %s %.3fs>' % (self.code, self.url, self.total)
+
+
+class Stats(object):
+    '''
+    aggregate of Transfers: counts, errors, status codes, bytes, and
+    percentiles of each timing computed on a sample of at most sample_size
+    transfers, so memory doesn't grow with their number. hosts holds the
+    Stats of the first max_hosts hosts, sampling HOST_SAMPLE_SIZE transfers
+    each, and of all the others together under OTHER_HOSTS, so memory
+    doesn't grow with the number of hosts either
+    '''
+
+    TIMINGS = ('namelookup', 'connect', 'appconnect', 'starttransfer',
+               'total')
+
+    def __init__(self, sample_size=SAMPLE_SIZE, by_host=True,
+                 max_hosts=MAX_HOSTS, rand=None):
+        self.sample_size = sample_size
+        self.max_hosts = max_hosts
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.codes = defaultdict(int)
+        self.sample = []
+        # shared with the Stats of each host
+        self.random = random.Random(0) if rand is None else rand
+        self.hosts = {} if by_host else None
+
+    def add(self, t):
+        self.count += 1
+        if t.error:
+            self.errors += 1
+        self.codes[t.code] += 1
+        self.bytes += t.size
+
+        # reservoir sampling
+        timings = tuple( getattr(t, name) for name in self.TIMINGS )
+        if len(self.sample) < self.sample_size:
+            self.sample.append(timings)
+        else:
+            i = self.random.randrange(self.count)
+            if i < self.sample_size:
+                self.sample[i] = timings
+
+        if self.hosts is not None:
+            host = t.host
+            if host not in self.hosts:
+                if len(self.hosts) >= self.max_hosts:
+                    host = OTHER_HOSTS
+                if host not in self.hosts:
+                    self.hosts[host] = Stats(
+                        min(self.sample_size, HOST_SAMPLE_SIZE),
+                        by_host=False, rand=self.random)
+            self.hosts[host].add(t)
+
+    def percentile(self, name, p):
+        '''
+        the p-th percentile of a timing, None without transfers
+        '''
+        if not self.sample:
+            return None
+        i = self.TIMINGS.index(name)
+        values = sorted( timings[i] for timings in self.sample )
+        return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        the stats as a JSON-able dict
+        '''
+        summary = {
+            'count': self.count,
+            'errors': self.errors,
+            'codes': dict(self.codes),
+            'bytes': self.bytes,
+            }
+        for name in self.TIMINGS:
+            summary[name] = dict( ('p%d' % p, self.percentile(name, p))
+                                  for p in percentiles )
+        if self.hosts is not None:
+            summary['hosts'] = dict(
+                (host, stats.summary(percentiles))
+                for host, stats in self.hosts.iteritems() )
+        return summary
+
+
+class Reporter(object):
+    '''
+    told about each Transfer as it is over, about progress while the
+    transfers go on and given the Stats once the batch is over, does
+    nothing. Override done to export the stats
+    '''
+
+    def transfer(self, t):
+        pass
+
+    def progress(self):
+        pass
+
+    def done(self, stats):
+        pass
+
 
+class PrintReporter(Reporter):
+    '''
+    print the code and url of each transfer, and dots as progress
+    '''
 
-def urlgrab(url_and_fnames, connect_timeout=CONNECT_TIMEOUT):
-    def show_code(c):
-        print c.getinfo(pycurl.HTTP_CODE), c.getinfo(pycurl.EFFECTIVE_URL)
+    def __init__(self, fp=None):
+        self.fp = fp or sys.stdout
 
-    opts = []
-    fps = []
+    def transfer(self, t):
+        print >> self.fp, t.code, t.url
+
+    def progress(self):
+        self.fp.write('.')
+        self.fp.flush()
+
+    def done(self, stats):
+        print >> self.fp
+
+
+class JSONReporter(Reporter):
+    '''
+    save the summary of the stats to a JSON file
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def done(self, stats):
+        write_atomic(self.fname, json.dumps(stats.summary(), indent=2,
+                                            sort_keys=True))
+
+
+class Cache(object):
+    '''
+    validators of downloaded urls kept in a directory, one JSON file per
+    url, so that urlgrab only asks for the bodies that changed
+
+    a cached file is revalidated with If-None-Match/If-Modified-Since, and
+    kept as it is on a 304. Entries stored more than max_age seconds ago are
+    dropped, and the least recently used ones beyond max_entries
+    '''
+
+    def __init__(self, directory, max_entries=None, max_age=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            with open(self.path(url)) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return meta
+
+    def put(self, url, meta):
+        meta['url'] = url
+        meta['atime'] = time.time()
+        write_atomic(self.path(url), json.dumps(meta))
+
+    def headers(self, url, fname):
+        '''
+        conditional request headers for url, if fname is still the file
+        that was downloaded from it
+        '''
+        meta = self.get(url)
+        if not meta or meta['fname'] != os.path.abspath(fname):
+            return []
+        try:
+            if os.path.getsize(fname) != meta['size']:
+                return []
+        except OSError:
+            return []
+
+        headers = []
+        if meta.get('etag'):
+            headers.append('If-None-Match: %s' % meta['etag'])
+        if meta.get('last_modified'):
+            headers.append('If-Modified-Since: %s' % meta['last_modified'])
+        return headers
+
+    def hit(self, url):
+        self.hits += 1
+        meta = self.get(url)
+        if meta:
+            self.put(url, meta)
+
+    def store(self, url, fname, headers):
+        self.misses += 1
+        if 'etag' not in headers and 'last-modified' not in headers:
+            self.remove(url)
+            return
+        meta = {
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'fname': os.path.abspath(fname),
+            'size': os.path.getsize(fname),
+            'stored': time.time(),
+            }
+        self.put(url, meta)
+
+    def remove(self, url):
+        try:
+            os.remove(self.path(url))
+        except OSError:
+            pass
+
+    def prune(self):
+        '''
+        drop expired entries, then the least recently used ones
+        '''
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as fp:
+                    meta = json.load(fp)
+                expired = self.max_age is not None and \
+                    now - meta['stored'] > self.max_age
+            except (IOError, ValueError, KeyError):
+                expired = True
+            if expired:
+                os.remove(path)
+            else:
+                entries.append((meta['atime'], path))
+
+        if self.max_entries is not None and len(entries) > self.max_entries:
+            entries.sort()
+            for atime, path in entries[:len(entries) - self.max_entries]:
+                os.remove(path)
+
+
+def write_atomic(fname, data):
+    fp = temp_file(fname)
     try:
+        fp.write(data)
+        fp.close()
+        os.rename(fp.name, fname)
+    except:
+        fp.close()
+        os.remove(fp.name)
+        raise
+
+
+_umask = None
+
+
+def file_mode():
+    '''
+    permissions open() gives to a new file under the umask of the process,
+    the umask is read once as reading it means changing it
+    '''
+    global _umask
+    if _umask is None:
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return 0666 & ~_umask
+
+
+def temp_file(fname):
+    '''
+    open a temporary file next to fname, to be renamed over it. It gets the
+    permissions of a file created with open(), not mkstemp's 0600
+    '''
+    dirname, basename = os.path.split(fname)
+    fd, path = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp',
+                                dir=dirname or '.')
+    os.close(fd)
+    os.chmod(path, file_mode())
+    return open(path, 'wb')
+
+
+class TransferError(Exception):
+    '''
+    a streamed transfer failed, or was answered with an error code, its
+    Transfer tells which
+    '''
+
+    def __init__(self, transfer):
+        Exception.__init__(self, transfer.error or transfer.code,
+                           transfer.url)
+        self.transfer = transfer
+
+
+def is_error_code(code):
+    '''
+    whether a response code means the body isn't what was asked for, FTP
+    and other protocols answer with codes below 300 too
+    '''
+    return code >= 300
+
+
+class Sink(object):
+    '''
+    feed a response body to a consumer chunk by chunk, the consumer is
+    either:
+
+    - a callable, called with each chunk
+    - a generator coroutine, sent each chunk and closed at the end, or
+      thrown a TransferError if the transfer failed
+    - a bounded Queue, which gets each chunk then None at the end, or a
+      TransferError if the transfer failed. The transfer is paused while
+      the queue is full, so at most maxsize chunks are held whatever the
+      size of the body
+
+    the bodies of error responses (codes 300 and up) are not fed, a
+    callable is told nothing about failures, see the Transfer of the handle
+    '''
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.is_queue = hasattr(consumer, 'put_nowait')
+        self.is_coroutine = not self.is_queue and hasattr(consumer, 'send')
+        # of the last HTTP response, handles can't be asked while running
+        self.code = 0
+
+    def setup(self, c):
+        if self.is_coroutine:
+            next(self.consumer)
+        c.setopt(pycurl.HEADERFUNCTION, self.header)
+        c.setopt(pycurl.WRITEFUNCTION, lambda chunk: self.write(c, chunk))
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            fields = line.split(None, 2)
+            if len(fields) > 1 and fields[1].isdigit():
+                self.code = int(fields[1])
+
+    def write(self, c, chunk):
+        if is_error_code(self.code):
+            return
+        if self.is_queue:
+            try:
+                self.consumer.put_nowait(chunk)
+            except Full:
+                # curl hands the same chunk again once resumed
+                c.resume = self.ready
+                return pycurl.WRITEFUNC_PAUSE
+        elif self.is_coroutine:
+            self.consumer.send(chunk)
+        else:
+            self.consumer(chunk)
+
+    def ready(self):
+        return not self.consumer.full()
+
+    def close(self, c):
+        '''
+        signal the end of the body once the transfer of handle c is over
+        '''
+        t = c.transfer
+        error = None
+        if t.error or is_error_code(t.code):
+            error = TransferError(t)
+
+        if self.is_queue:
+            self.consumer.put(error)
+        elif self.is_coroutine:
+            if error is None:
+                self.consumer.close()
+                return
+            try:
+                self.consumer.throw(error)
+            except (TransferError, StopIteration):
+                pass
+            else:
+                self.consumer.close()
+
+
+class AsyncBatch(Batch):
+    '''
+    run a Batch from an asyncio style event loop through curl's socket
+    interface: the loop watches the sockets and the timeout curl asks for
+    and only wakes curl up when one of them fires, nothing polls
+
+    the loop needs add_reader, remove_reader, add_writer, remove_writer and
+    call_later, as asyncio and trollius loops or SelectLoop provide
+    '''
+
+    def __init__(self, session, opts, loop, concurrency=CONCURRENCY,
+                 per_host=None, result=None, cleanup=None, stats=None,
+                 reporter=None):
+        Batch.__init__(self, session, opts, concurrency, per_host,
+                       pycurl.CurlMulti(), stats, reporter)
+        self.loop = loop
+        self.result = result
+        self.cleanup = cleanup
+        self.timer = None
+        self.sockets = {}
+        if hasattr(loop, 'create_future'):
+            self.future = loop.create_future()
+        else:
+            self.future = Future()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer)
+
+    def on_socket(self, what, fd, multi, data):
+        watched = self.sockets.pop(fd, pycurl.POLL_NONE)
+        if what == pycurl.POLL_REMOVE:
+            what = pycurl.POLL_NONE
+        for flag, add, remove, event in (
+            (pycurl.POLL_IN, self.loop.add_reader, self.loop.remove_reader,
+             pycurl.CSELECT_IN),
+            (pycurl.POLL_OUT, self.loop.add_writer, self.loop.remove_writer,
+             pycurl.CSELECT_OUT)):
+            if what & flag:
+                add(fd, self.action, fd, event)
+            elif watched & flag:
+                remove(fd)
+        if what:
+            self.sockets[fd] = what
+
+    def on_timer(self, timeout_ms):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if timeout_ms >= 0:
+            self.timer = self.loop.call_later(timeout_ms / 1000.0,
+                self.action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def action(self, fd, event):
+        if fd == pycurl.SOCKET_TIMEOUT:
+            self.timer = None
+        if self.future.done():
+            return
+        try:
+            while 1:
+                ret, num_handles = self.multi.socket_action(fd, event)
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            self.check()
+        except Exception, e:
+            self.fail(e)
+
+    def start_all(self):
+        try:
+            self.check()
+        except Exception, e:
+            self.fail(e)
+
+    def check(self):
+        for c in self.completed():
+            pass
+        self.fill()
+        self.reporter.progress()
+        if not self.active:
+            self.close()
+            self.stop()
+            self.future.set_result(self.result() if self.result
+                                   else self.stats)
+
+    def fail(self, error):
+        try:
+            self.close()
+        finally:
+            self.stop()
+            if not self.future.done():
+                self.future.set_exception(error)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for fd in list(self.sockets):
+            self.on_socket(pycurl.POLL_REMOVE, fd, self.multi, None)
+        self.multi.close()
+        if self.cleanup:
+            self.cleanup()
+
+
+class Future(object):
+    '''
+    minimal future for loops that can't create their own
+    '''
+
+    def __init__(self):
+        self.callbacks = []
+        self.value = self.error = None
+        self.finished = False
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        assert self.finished, 'future is not done yet'
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def set_result(self, value):
+        self.value = value
+        self.finish()
+
+    def set_exception(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.finished = True
+        for fn in self.callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        if self.finished:
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+
+class Timer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SelectLoop(object):
+    '''
+    the subset of an asyncio event loop AsyncBatch needs, on epoll (or
+    poll), for programs that have neither asyncio nor trollius
+    '''
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1.0
+        else:
+            self.poller = select.poll()
+            self.scale = 1000.0
+        self.readers = {}
+        self.writers = {}
+        self.masks = {}
+        self.timers = []
+        self.seq = itertools.count()
+
+    def time(self):
+        return time.time()
+
+    def update(self, fd):
+        mask = (select.POLLIN if fd in self.readers else 0) | \
+            (select.POLLOUT if fd in self.writers else 0)
+        if not mask:
+            if self.masks.pop(fd, None):
+                self.poller.unregister(fd)
+        elif fd in self.masks:
+            self.poller.modify(fd, mask)
+            self.masks[fd] = mask
+        else:
+            self.poller.register(fd, mask)
+            self.masks[fd] = mask
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+        self.update(fd)
+
+    def remove_reader(self, fd):
+        found = self.readers.pop(fd, None) is not None
+        self.update(fd)
+        return found
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+        self.update(fd)
+
+    def remove_writer(self, fd):
+        found = self.writers.pop(fd, None) is not None
+        self.update(fd)
+        return found
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.seq), timer))
+        return timer
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def run_once(self):
+        timeout = -1
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - self.time())
+        elif not self.masks:
+            return
+        if timeout >= 0:
+            timeout *= self.scale
+
+        errors = select.POLLERR | select.POLLHUP
+        for fd, event in self.poller.poll(timeout):
+            if event & (select.POLLIN | errors) and fd in self.readers:
+                callback, args = self.readers[fd]
+                callback(*args)
+            if event & (select.POLLOUT | errors) and fd in self.writers:
+                callback, args = self.writers[fd]
+                callback(*args)
+
+        now = self.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+
+def get_event_loop():
+    for name in ('asyncio', 'trollius'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        return module.get_event_loop()
+    raise RuntimeError('no asyncio nor trollius, pass loop=SelectLoop()')
+
+
+class Checkpoint(object):
+    '''
+    the urls checked so far and their results, in a sqlite database so that
+    memory doesn't grow with the number of urls and a run resumes where an
+    interrupted one stopped. Without a path the database is a temporary
+    file removed on close
+
+    results are committed every commit_every urls, an interrupted run
+    checks again at most that many
+    '''
+
+    def __init__(self, path=None, commit_every=1000):
+        self.temp = None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            self.temp = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS checked
+            (url TEXT PRIMARY KEY, code INTEGER, elapsed REAL)''')
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def done(self, url):
+        return self.db.execute('SELECT 1 FROM checked WHERE url = ?',
+                               (url,)).fetchone() is not None
+
+    def add(self, url, code, elapsed):
+        self.db.execute('INSERT OR IGNORE INTO checked VALUES (?, ?, ?)',
+                        (url, code, elapsed))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def results(self):
+        return self.db.execute('SELECT url, code, elapsed FROM checked')
+
+    def close(self):
+        self.commit()
+        self.db.close()
+        if self.temp:
+            os.remove(self.temp)
+
+
+def read_header(headers, line):
+    '''
+    header function keeping the headers of the last response in a dict
+    keyed by lower case names
+    '''
+    if line.startswith('HTTP/'):
+        # a new response after a redirect
+        headers.clear()
+        return
+    name, sep, value = line.partition(':')
+    if sep:
+        headers[name.strip().lower()] = value.strip()
+
+
+class Segments(object):
+    '''
+    a download split in count byte ranges, each written at its offset in a
+    preallocated fname.part. The ranges done so far are kept in the
+    fname.part.json sidecar, so an interrupted download only fetches the
+    missing ones. fname.part becomes fname once all of them are done
+    '''
+
+    def __init__(self, url, fname, size, count):
+        self.url = url
+        self.fname = fname
+        self.size = size
+        self.part = fname + '.part'
+        self.sidecar = self.part + '.json'
+        step = -(-size // count)
+        self.ranges = [ (start, min(start + step, size) - 1)
+                        for start in xrange(0, size, step) ]
+
+        self.done = set()
+        meta = self.load()
+        if meta and meta['url'] == url.url and meta['size'] == size and \
+                map(tuple, meta['ranges']) == self.ranges and \
+                os.path.exists(self.part) and \
+                os.path.getsize(self.part) == size:
+            self.done.update(meta['done'])
+        else:
+            with open(self.part, 'wb') as fp:
+                fp.truncate(size)
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.sidecar) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def save(self):
+        write_atomic(self.sidecar, json.dumps({
+            'url': self.url.url,
+            'size': self.size,
+            'ranges': self.ranges,
+            'done': sorted(self.done),
+            }))
+
+    def missing(self):
+        return [ i for i in range(len(self.ranges)) if i not in self.done ]
+
+    def finish(self, i):
+        self.done.add(i)
+        if len(self.done) < len(self.ranges):
+            self.save()
+            return
+        os.rename(self.part, self.fname)
+        os.remove(self.sidecar)
+
+
+_local = threading.local()
+
+
+def default_session():
+    '''
+    the Session used when none is given, one per thread as curl handles
+    can't be shared between threads
+    '''
+    if not hasattr(_local, 'session'):
+        _local.session = Session()
+    return _local.session
+
+
+class Session(object):
+    '''
+    transfer state kept across calls: a pool of CurlMultis and their
+    connection caches, one per running Batch, a CurlShare for DNS lookups,
+    TLS sessions (and connections when libcurl supports it), and a pool of
+    reusable easy handles
+    '''
+
+    def __init__(self):
+        self.multis = []
+        self.share = pycurl.CurlShare()
+        for data in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION',
+                     'LOCK_DATA_CONNECT'):
+            if hasattr(pycurl, data):
+                self.share.setopt(pycurl.SH_SHARE, getattr(pycurl, data))
+        self.free = []
+
+    def handle(self):
+        if self.free:
+            return self.free.pop()
+        c = pycurl.Curl()
+        # reset() keeps the share
+        c.setopt(pycurl.SHARE, self.share)
+        return c
+
+    def release(self, c):
+        c.reset()
+        self.free.append(c)
+
+    def acquire_multi(self):
+        '''
+        a CurlMulti no Batch is using, the last released one first so that
+        consecutive batches find its connections open
+        '''
+        if self.multis:
+            return self.multis.pop()
+        return pycurl.CurlMulti()
+
+    def release_multi(self, multi):
+        self.multis.append(multi)
+
+    def grab_opts(self, url_and_fnames, fps, connect_timeout=CONNECT_TIMEOUT,
+                  cache=None):
+        '''
+        options to download urls to files, open files are kept in the fps
+        set until their transfer is over
+
+        bodies go to a temporary file renamed over the target once the
+        transfer succeeded with a 2xx code, so a failed one or an error
+        page leaves the old file, and its cache entry, as they were
+        '''
+        # files are opened when their transfer starts, not all up front
+        def open_file(url, fname):
+            def setup(c):
+                c.fp = temp_file(fname)
+                fps.add(c.fp)
+                c.setopt(pycurl.WRITEDATA, c.fp)
+                if cache:
+                    c.headers = {}
+                    c.setopt(pycurl.HEADERFUNCTION,
+                             lambda line: read_header(c.headers, line))
+                    headers = cache.headers(url.url, fname)
+                    if headers:
+                        c.setopt(pycurl.HTTPHEADER, headers)
+            return setup
+
+        def close_file(url, fname):
+            def callback(c):
+                fps.discard(c.fp)
+                c.fp.close()
+                code = c.getinfo(pycurl.HTTP_CODE)
+                if not c.error and 200 <= code < 300:
+                    os.rename(c.fp.name, fname)
+                else:
+                    os.remove(c.fp.name)
+
+                if not cache or c.error:
+                    return
+                if code == 304:
+                    cache.hit(url.url)
+                elif code == 200:
+                    cache.store(url.url, fname, c.headers)
+            return callback
+
         for url, fname in url_and_fnames:
-            fps.append(open(fname, 'w'))
             opt = {
                 pycurl.URL: url.url,
                 pycurl.SSL_VERIFYPEER: 0,
                 pycurl.SSL_VERIFYHOST: 0,
                 pycurl.FOLLOWLOCATION: 1,
                 pycurl.CONNECTTIMEOUT: connect_timeout,
-                pycurl.WRITEDATA: fps[-1],
-                'callback': show_code,
+                'setup': open_file(url, fname),
+                'callback': close_file(url, fname),
                 }
             if url.userpwd:
                 opt[pycurl.USERPWD] = url.userpwd
-            opts.append(opt)
-        return poll(opts)
-    except:
-        raise
-    finally:
-        for fp in fps:
-            fp.close()
-
-
-def urlexists(urls, connect_timeout=CONNECT_TIMEOUT):
-    exists = {}
-    def check_200(url):
-        def callback(c):
-            code = c.getinfo(pycurl.HTTP_CODE)
-            print code, c.getinfo(pycurl.EFFECTIVE_URL)
-            exists[url] = (code == 200)
-        return callback
-
-    opts = []
-    for url in urls:
-        opt = {
-            pycurl.URL: url.url,
-            pycurl.SSL_VERIFYPEER: 0,
-            pycurl.SSL_VERIFYHOST: 0,
-            pycurl.FOLLOWLOCATION: 1,
-            pycurl.CONNECTTIMEOUT: connect_timeout,
-            pycurl.NOBODY: 1,
-            'callback': check_200(url),
-            }
-        if url.userpwd:
-            opt[pycurl.USERPWD] = url.userpwd
-        opts.append(opt)
+            yield opt
 
-    poll(opts)
-    return exists
+    def probe_opts(self, urls, probes, connect_timeout=CONNECT_TIMEOUT):
+        '''
+        options to ask for the size of urls and whether they serve ranges,
+        the size or None goes to the probes dict
+        '''
+        def probe(url):
+            def setup(c):
+                c.headers = {}
+                c.setopt(pycurl.HEADERFUNCTION,
+                         lambda line: read_header(c.headers, line))
+            def callback(c):
+                size = c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+                if c.error or c.getinfo(pycurl.HTTP_CODE) != 200 or \
+                        size <= 0 or c.headers.get('accept-ranges') != 'bytes':
+                    probes[url.url] = None
+                else:
+                    probes[url.url] = int(size)
+            return setup, callback
 
+        for url in urls:
+            setup, callback = probe(url)
+            opt = {
+                pycurl.URL: url.url,
+                pycurl.SSL_VERIFYPEER: 0,
+                pycurl.SSL_VERIFYHOST: 0,
+                pycurl.FOLLOWLOCATION: 1,
+                pycurl.CONNECTTIMEOUT: connect_timeout,
+                pycurl.NOBODY: 1,
+                'setup': setup,
+                'callback': callback,
+                }
+            if url.userpwd:
+                opt[pycurl.USERPWD] = url.userpwd
+            yield opt
 
-def poll(opts, timeout=1):
-    def create_multi():
-        m = pycurl.CurlMulti()
-        m.handles = []
+    def segment_opts(self, segments, fps, connect_timeout=CONNECT_TIMEOUT):
+        '''
+        options to download the missing ranges of Segments, open files are
+        kept in the fps set until their transfer is over
+        '''
+        def fetch(seg, i):
+            start, end = seg.ranges[i]
+            length = end - start + 1
 
-        for opt in opts:
-            c = pycurl.Curl()
-            for key, val in opt.iteritems():
-                if key == 'callback':
-                    c.callback = val
-                else:
-                    c.setopt(key, val)
-            m.add_handle(c)
-            m.handles.append(c)
-        return m
-
-    def loop(m):
-        num_handles = len(m.handles)
-        while num_handles:
-            while 1:
-                ret, num_handles = m.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                    break
+            def write(c, chunk):
+                c.received += len(chunk)
+                # a server ignoring the range would overwrite the others
+                if c.received > length:
+                    return 0
+                c.fp.write(chunk)
+
+            def setup(c):
+                c.fp = open(seg.part, 'r+b')
+                c.fp.seek(start)
+                fps.add(c.fp)
+                c.received = 0
+                c.setopt(pycurl.WRITEFUNCTION, lambda chunk: write(c, chunk))
+
+            def callback(c):
+                fps.discard(c.fp)
+                c.fp.close()
+                if not c.error and c.getinfo(pycurl.HTTP_CODE) == 206 and \
+                        c.received == length:
+                    seg.finish(i)
+            return setup, callback
+
+        for seg in segments:
+            for i in seg.missing():
+                setup, callback = fetch(seg, i)
+                opt = {
+                    pycurl.URL: seg.url.url,
+                    pycurl.SSL_VERIFYPEER: 0,
+                    pycurl.SSL_VERIFYHOST: 0,
+                    pycurl.FOLLOWLOCATION: 1,
+                    pycurl.CONNECTTIMEOUT: connect_timeout,
+                    pycurl.RANGE: '%d-%d' % seg.ranges[i],
+                    'setup': setup,
+                    'callback': callback,
+                    }
+                if seg.url.userpwd:
+                    opt[pycurl.USERPWD] = seg.url.userpwd
+                yield opt
+
+    def split(self, url_and_fnames, segments, threshold, connect_timeout,
+              concurrency, per_host):
+        '''
+        ask for the size of all urls, return the (url, fname) pairs to
+        download as a whole and the Segments of the others
+        '''
+        url_and_fnames = list(url_and_fnames)
+        probes = {}
+        self.poll(self.probe_opts([ url for url, fname in url_and_fnames ],
+                                  probes, connect_timeout),
+                  concurrency=concurrency, per_host=per_host)
+
+        whole, split = [], []
+        for url, fname in url_and_fnames:
+            size = probes.get(url.url)
+            if size is None or size < threshold:
+                whole.append((url, fname))
+            else:
+                split.append(Segments(url, fname, size, segments))
+        return whole, split
+
+    def exists_opts(self, urls, exists, connect_timeout=CONNECT_TIMEOUT):
+        '''
+        options to check urls, whether each one answers 200 goes to the
+        exists dict
+        '''
+        def check_200(url):
+            def callback(c):
+                exists[url] = (c.getinfo(pycurl.HTTP_CODE) == 200)
+            return callback
+
+        for url in urls:
+            opt = {
+                pycurl.URL: url.url,
+                pycurl.SSL_VERIFYPEER: 0,
+                pycurl.SSL_VERIFYHOST: 0,
+                pycurl.FOLLOWLOCATION: 1,
+                pycurl.CONNECTTIMEOUT: connect_timeout,
+                pycurl.NOBODY: 1,
+                'callback': check_200(url),
+                }
+            if url.userpwd:
+                opt[pycurl.USERPWD] = url.userpwd
+            yield opt
+
+    def stream_opts(self, url_and_consumers, connect_timeout=CONNECT_TIMEOUT,
+                    chunk_size=None):
+        '''
+        options to stream bodies into consumers, chunk_size sets the size of
+        curl's receive buffer and so of the chunks
+        '''
+        for url, consumer in url_and_consumers:
+            sink = Sink(consumer)
+            opt = {
+                pycurl.URL: url.url,
+                pycurl.SSL_VERIFYPEER: 0,
+                pycurl.SSL_VERIFYHOST: 0,
+                pycurl.FOLLOWLOCATION: 1,
+                pycurl.CONNECTTIMEOUT: connect_timeout,
+                'setup': sink.setup,
+                'callback': sink.close,
+                }
+            if chunk_size:
+                opt[pycurl.BUFFERSIZE] = chunk_size
+            if url.userpwd:
+                opt[pycurl.USERPWD] = url.userpwd
+            yield opt
+
+    def urlgrab(self, url_and_fnames, connect_timeout=CONNECT_TIMEOUT,
+                concurrency=CONCURRENCY, per_host=None, cache=None,
+                segments=1, segment_threshold=SEGMENT_THRESHOLD, stats=None,
+                reporter=None):
+        '''
+        download urls to files, with a Cache only the changed ones, return
+        the Stats of the transfers
+
+        with segments > 1, the urls are asked for their size first, and the
+        files of at least segment_threshold bytes served with ranges are
+        fetched in that many ranges at once, resuming the missing ones of
+        an interrupted download. They don't go through the cache
+        '''
+        fps, parts = set(), set()
+        try:
+            if segments > 1:
+                url_and_fnames, split = self.split(url_and_fnames, segments,
+                    segment_threshold, connect_timeout, concurrency, per_host)
+            else:
+                split = []
+            opts = itertools.chain(
+                self.segment_opts(split, parts, connect_timeout),
+                self.grab_opts(url_and_fnames, fps, connect_timeout, cache))
+            return self.poll(opts, concurrency=concurrency,
+                             per_host=per_host, stats=stats,
+                             reporter=reporter)
+        except:
+            raise
+        finally:
+            for fp in fps:
+                fp.close()
+                os.remove(fp.name)
+            for fp in parts:
+                fp.close()
+            if cache:
+                cache.prune()
 
-            # show progress
-            sys.stdout.write('.')
-            sys.stdout.flush()
+    def urlcheck(self, urls, checkpoint=None, connect_timeout=CONNECT_TIMEOUT,
+                 concurrency=CONCURRENCY, per_host=None, timeout=1,
+                 stats=None, reporter=None):
+        '''
+        check urls read lazily from an iterable of URLs or strings (such as
+        the lines of a file), skipping duplicates, and yield (url, code,
+        elapsed) as each check is over. code is 0 when there was no answer
 
+        urls checked before in the checkpoint, a Checkpoint or the path of
+        its database, are skipped. Memory is bounded by concurrency and
+        MAX_WAITING whatever the number of urls, the Stats made without
+        stats don't keep those of each host
+        '''
+        if stats is None:
+            stats = Stats(by_host=False)
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        # queued urls, not in the checkpoint yet
+        inflight = set()
+
+        def record(url):
+            def callback(c):
+                inflight.discard(url.url)
+                c.result = (url, c.transfer.code, c.transfer.total)
+                # aborted checks are done again on resume
+                if not c.error or c.error[0] != pycurl.E_ABORTED_BY_CALLBACK:
+                    checkpoint.add(url.url, *c.result[1:])
+            return callback
+
+        def check_opts():
+            for url in urls:
+                if not isinstance(url, URL):
+                    url = url.strip()
+                    if not url:
+                        continue
+                    url = URL(url)
+                if url.url in inflight or checkpoint.done(url.url):
+                    continue
+                inflight.add(url.url)
+                opt = {
+                    pycurl.URL: url.url,
+                    pycurl.SSL_VERIFYPEER: 0,
+                    pycurl.SSL_VERIFYHOST: 0,
+                    pycurl.FOLLOWLOCATION: 1,
+                    pycurl.CONNECTTIMEOUT: connect_timeout,
+                    pycurl.NOBODY: 1,
+                    'callback': record(url),
+                    }
+                if url.userpwd:
+                    opt[pycurl.USERPWD] = url.userpwd
+                yield opt
+
+        batch = Batch(self, check_opts(), concurrency, per_host,
+                      stats=stats, reporter=reporter)
+        try:
+            for c in batch.run(timeout):
+                yield c.result
+        finally:
             try:
-                m.select(timeout)
-            except KeyboardInterrupt:
-                print 'User press CTRL-C'
-                raise # or break
-        print
-
-    def callback(m):
-        for c in m.handles:
-            if hasattr(c, 'callback'):
-                c.callback(c)
-
-    def cleanup(m):
-        for c in m.handles:
-            m.remove_handle(c)
-            c.close()
-        del m.handles
+                batch.close()
+            finally:
+                checkpoint.close()
 
-    m = create_multi()
-    try:
-        loop(m)
-    except:
-        raise
-    finally:
-        callback(m)
-        cleanup(m)
+    def urlexists(self, urls, connect_timeout=CONNECT_TIMEOUT,
+                  concurrency=CONCURRENCY, per_host=None, stats=None,
+                  reporter=None):
+        exists = {}
+        self.poll(self.exists_opts(urls, exists, connect_timeout),
+                  concurrency=concurrency, per_host=per_host, stats=stats,
+                  reporter=reporter)
+        return exists
+
+    def urlstream(self, url_and_consumers, connect_timeout=CONNECT_TIMEOUT,
+                  concurrency=CONCURRENCY, per_host=None, chunk_size=None,
+                  stats=None, reporter=None):
+        return self.poll(self.stream_opts(url_and_consumers, connect_timeout,
+                                          chunk_size),
+                         concurrency=concurrency, per_host=per_host,
+                         stats=stats, reporter=reporter)
+
+    def aurlgrab(self, url_and_fnames, connect_timeout=CONNECT_TIMEOUT,
+                 concurrency=CONCURRENCY, per_host=None, loop=None,
+                 stats=None, reporter=None):
+        fps = set()
+        def close_files():
+            for fp in fps:
+                fp.close()
+                os.remove(fp.name)
+        return self.apoll(self.grab_opts(url_and_fnames, fps, connect_timeout),
+                          concurrency=concurrency, per_host=per_host,
+                          loop=loop, cleanup=close_files, stats=stats,
+                          reporter=reporter)
+
+    def aurlexists(self, urls, connect_timeout=CONNECT_TIMEOUT,
+                   concurrency=CONCURRENCY, per_host=None, loop=None,
+                   stats=None, reporter=None):
+        exists = {}
+        return self.apoll(self.exists_opts(urls, exists, connect_timeout),
+                          concurrency=concurrency, per_host=per_host,
+                          loop=loop, result=lambda: exists, stats=stats,
+                          reporter=reporter)
+
+    def poll(self, opts, timeout=1, concurrency=CONCURRENCY, per_host=None,
+             stats=None, reporter=None):
+        '''
+        run the transfers of the option dicts, return their Stats
+        '''
+        batch = Batch(self, opts, concurrency, per_host, stats=stats,
+                      reporter=reporter)
+        try:
+            for c in batch.run(timeout):
+                pass
+        finally:
+            batch.close()
+        return batch.stats
+
+    def apoll(self, opts, concurrency=CONCURRENCY, per_host=None, loop=None,
+              result=None, cleanup=None, stats=None, reporter=None):
+        '''
+        start the transfers on an event loop and return a future of
+        result(), or of their Stats without it. cleanup() runs once they
+        are over or failed
+        '''
+        batch = AsyncBatch(self, opts, loop or get_event_loop(), concurrency,
+                           per_host, result, cleanup, stats, reporter)
+        batch.start_all()
+        return batch.future
+
+    def close(self):
+        for c in self.free:
+            c.close()
+        del self.free[:]
+        for multi in self.multis:
+            multi.close()
+        del self.multis[:]
+        self.share.close()
 
 
 class URL(object):
@@ -137,6 +1535,14 @@ class URL(object):
     def __hash__(self):
         return hash(self.url)
 
+    def __eq__(self, other):
+        if not isinstance(other, URL):
+            return NotImplemented
+        return self.url == other.url
+
+    def __ne__(self, other):
+        return not self == other
+
     def __str__(self):
         return self.url
 
@@ -159,7 +1565,7 @@ def test_fetch():
         ]]
 
     url_and_fnames = [ (url, os.path.join('download', os.path.basename(url.url))) for url in urls ]
-    urlgrab(url_and_fnames)
+    print urlgrab(url_and_fnames, reporter=PrintReporter()).summary()
 
 
 if __name__ == '__main__':
@@ -1,78 +1,819 @@
+import bisect
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
 import itertools
+import mmap
+import multiprocessing
+import re
+import threading
+import weakref
+from collections import OrderedDict, defaultdict
+from cStringIO import StringIO
 
+import cssselect
 from lxml import etree
-from lxml.cssselect import CSSSelector
+from lxml.cssselect import CSSSelector, LxmlTranslator
 
 
+SELECTOR_CACHE_SIZE = 512
+
+
+class SelectorCache(object):
+    '''
+    process-wide LRU cache of compiled CSS selectors keyed by selector string
+    (or by any other hashable key ``compile`` knows how to handle)
+    '''
+
+    def __init__(self, maxsize=SELECTOR_CACHE_SIZE, compile=CSSSelector):
+        self.maxsize = maxsize
+        self.compile = compile
+        self.hits = 0
+        self.misses = 0
+        self._selectors = OrderedDict()
+
+    def __call__(self, sel):
+        try:
+            compiled = self._selectors.pop(sel)
+        except KeyError:
+            self.misses += 1
+            compiled = self.compile(sel)
+            if len(self._selectors) >= self.maxsize:
+                self._selectors.popitem(last=False)
+        else:
+            self.hits += 1
+        self._selectors[sel] = compiled
+        return compiled
+
+    def __len__(self):
+        return len(self._selectors)
+
+    def __contains__(self, sel):
+        return sel in self._selectors
+
+    def warm(self, sels):
+        '''
+        compile selectors ahead of time, e.g. at process startup
+        '''
+        for sel in sels:
+            if sel not in self._selectors:
+                self(sel)
+        return self
+
+    def clear(self):
+        self._selectors.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._selectors),
+                'maxsize': self.maxsize,
+                }
+
+
+def compile_path(sels):
+    '''
+    compile a sequence of CSS selector strings, each applied to the results
+    of the previous one, into a single XPath expression
+    '''
+    translator = LxmlTranslator()
+    steps = [ [ translator.selector_to_xpath(i) for i in cssselect.parse(sel) ]
+              for sel in sels ]
+    return etree.XPath(' | '.join([ '/'.join(i)
+                                    for i in itertools.product(*steps) ]))
+
+
+# axis leading from an element to the one the left side of a combinator
+# has to match
+_COMBINATOR_AXES = {
+    ' ': 'ancestor::',
+    '>': 'parent::',
+    '~': 'preceding-sibling::',
+    }
+
+
+def _context_step(translator, node, axis='self::'):
+    '''
+    XPath location step that selects, from the context node, the element
+    matched by the subject of parsed selector node, through axis
+    '''
+    if not isinstance(node, cssselect.parser.CombinedSelector):
+        return axis + str(translator.xpath(node))
+    step = axis + str(translator.xpath(node.subselector))
+    if node.combinator == '+':
+        context = 'preceding-sibling::*[1][%s]' % _context_step(
+            translator, node.selector)
+    else:
+        context = _context_step(translator, node.selector,
+                                _COMBINATOR_AXES[node.combinator])
+    return '%s[%s]' % (step, context)
+
+
+def compile_test(sel):
+    '''
+    compile CSS selector string into an XPath expression telling whether
+    the context element matches it, by looking at its ancestors and
+    preceding siblings only, instead of at the whole document
+    '''
+    translator = LxmlTranslator()
+    steps = [ _context_step(translator, i.parsed_tree)
+              for i in cssselect.parse(sel) ]
+    return etree.XPath('boolean(%s)' % ' | '.join(steps))
+
+
+selector_cache = SelectorCache()
+path_cache = SelectorCache(compile=compile_path)
+test_cache = SelectorCache(compile=compile_test)
+
+
+def _drop_preceding(elem):
+    '''
+    delete the siblings before elem, the root has no parent to delete its
+    prolog comments and PIs from
+    '''
+    parent = elem.getparent()
+    if parent is None:
+        return
+    while elem.getprevious() is not None:
+        del parent[0]
+
+
+def _subject_tags(sel):
+    '''
+    return the set of tag names an element must have to match CSS selector
+    string, or None if any tag could match
+    '''
+    tags = set()
+    for selector in cssselect.parse(sel):
+        node = selector.parsed_tree
+        while not isinstance(node, cssselect.parser.Element):
+            if isinstance(node, cssselect.parser.CombinedSelector):
+                node = node.subselector
+            else:
+                node = node.selector
+        if node.element is None or node.namespace is not None:
+            return None
+        tags.add(node.element)
+    return tags
+
+
+def _compound_keys(node):
+    '''
+    return index keys of a compound selector, and whether they are all an
+    element needs to match it
+    '''
+    keys = []
+    exact = True
+    while 1:
+        if isinstance(node, cssselect.parser.Element):
+            if node.namespace is not None:
+                exact = False
+            elif node.element is not None:
+                keys.append(('tags', node.element))
+            return keys, exact
+
+        if isinstance(node, cssselect.parser.Class):
+            keys.append(('classes', node.class_name))
+        elif isinstance(node, cssselect.parser.Hash):
+            keys.append(('ids', node.id))
+        elif isinstance(node, cssselect.parser.Attrib) and \
+            node.namespace is None:
+            keys.append(('attrs', node.attrib))
+            exact = exact and node.operator == 'exists'
+        else:
+            exact = False
+        node = node.selector
+
+
+def plan_query(sel):
+    '''
+    decide how an ElementIndex answers CSS selector string, returns a tuple
+    (kind, keys, check) where kind is one of
+
+    index: the elements are looked up by keys, and filtered with the check
+    XPath if keys are not enough to match the selector
+    subtree: the selector only runs on the outermost elements found by the
+    keys of its leftmost compound selector
+    scan: the index can't help
+    '''
+    scan = ('scan', None, None)
+    selectors = cssselect.parse(sel)
+    if len(selectors) != 1 or selectors[0].pseudo_element:
+        return scan
+
+    node = selectors[0].parsed_tree
+    if not isinstance(node, cssselect.parser.CombinedSelector):
+        keys, exact = _compound_keys(node)
+        if not keys:
+            return scan
+        check = None
+        if not exact:
+            check = etree.XPath(LxmlTranslator().selector_to_xpath(
+                selectors[0], prefix='self::'))
+        return ('index', keys, check)
+
+    while isinstance(node, cssselect.parser.CombinedSelector):
+        # other combinators reach outside of the candidate subtrees
+        if node.combinator not in (' ', '>'):
+            return scan
+        node = node.selector
+    keys, _ = _compound_keys(node)
+    if not keys:
+        return scan
+    return ('subtree', keys, None)
+
+
+plan_cache = SelectorCache(compile=plan_query)
+
+
+class Generation(object):
+    '''
+    modification counter of one tree, bumped by every modification made
+    through XQuery, invalidates the indexes and fingerprints cached on its
+    nodes
+    '''
+
+    __slots__ = ('root', 'value', '__weakref__')
+
+    def __init__(self, root):
+        # holding the root keeps its proxy, and so its id, alive as long
+        # as somebody caches against this counter
+        self.root = root
+        self.value = 0
+
+
+# id of the root element of a tree -> its Generation, only for trees with
+# cached data
+_generations = weakref.WeakValueDictionary()
+
+
+def generation(elem):
+    '''
+    return the Generation of the tree elem belongs to
+    '''
+    root = elem.getroottree().getroot()
+    counter = _generations.get(id(root))
+    if counter is None or counter.root is not root:
+        counter = _generations[id(root)] = Generation(root)
+    return counter
+
+
+def touch(elem):
+    '''
+    record a modification of the tree elem belongs to
+    '''
+    root = elem.getroottree().getroot()
+    counter = _generations.get(id(root))
+    if counter is not None and counter.root is root:
+        counter.value += 1
+
+
+# lazy chains whose query hasn't run yet, by id since hashing a chain
+# runs it
+_pending_chains = weakref.WeakValueDictionary()
+
+
+def force_pending(*elems):
+    '''
+    run the queries of the lazy chains looking at the trees elems belong
+    to, modifications call this first so that a chain sees the tree as it
+    was when find() was called
+    '''
+    trees = set( i.getroottree().getroot() for i in elems )
+    for chain in _pending_chains.values():
+        roots = chain._pending and chain._pending[0]
+        if roots and any( i.getroottree().getroot() in trees
+                          for i in roots ):
+            chain.force()
+
+
+def _stamp(elem):
+    '''
+    return what a cache of data about elem compares to tell if it's fresh
+    '''
+    counter = generation(elem)
+    return counter, counter.value
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def fingerprint(root, memo=None):
+    '''
+    Merkle-style SHA1 digest of an element subtree, following the rules of
+    XQuery.is_etree_node_eq: tag, child structure and leaf text with None
+    and '' being equal
+
+    the digest of every element of the subtree is stored in the memo dict
+    if one is given
+    '''
+    stack = [(root, iter(root), [])]
+    while 1:
+        elem, children, digests = stack[-1]
+        for child in children:
+            stack.append((child, iter(child), []))
+            break
+        else:
+            stack.pop()
+            tag = elem.tag
+            if not isinstance(tag, basestring):
+                # comments and PIs, no tag name can start with a NUL
+                tag = '\0' + tag.__name__
+            md = hashlib.sha1(_encode(tag))
+            if digests:
+                md.update('\0C')
+                md.update(''.join(digests))
+            else:
+                md.update('\0T')
+                md.update(_encode(elem.text or ''))
+            digest = md.digest()
+            if memo is not None:
+                memo[elem] = digest
+            if not stack:
+                return digest
+            stack[-1][2].append(digest)
+
+
+def _path_steps(children):
+    '''
+    XPath-like location step of each element of a list of siblings
+    '''
+    counts = defaultdict(int)
+    steps = []
+    for child in children:
+        tag = child.tag
+        if tag is etree.Comment:
+            tag = 'comment()'
+        elif tag is etree.ProcessingInstruction:
+            tag = 'processing-instruction()'
+        elif not isinstance(tag, basestring):
+            tag = tag.__name__
+        counts[tag] += 1
+        steps.append('/%s[%d]' % (tag, counts[tag]))
+    return steps
+
+
+def _common_subsequence(left, right):
+    '''
+    longest common subsequence of two lists of hashable values, as a list of
+    (left index, right index) pairs (Hunt-Szymanski)
+    '''
+    positions = defaultdict(list)
+    for j, value in enumerate(right):
+        positions[value].append(j)
+
+    # tails[k] is the smallest right index that ends a common subsequence
+    # of length k + 1, links[k] the (i, j, previous link) chain ending it
+    tails, links = [], []
+    for i, value in enumerate(left):
+        for j in reversed(positions.get(value, ())):
+            k = bisect.bisect_left(tails, j)
+            link = (i, j, links[k-1] if k else None)
+            if k == len(tails):
+                tails.append(j)
+                links.append(link)
+            else:
+                tails[k] = j
+                links[k] = link
+
+    pairs = []
+    link = links[-1] if links else None
+    while link is not None:
+        pairs.append(link[:2])
+        link = link[2]
+    pairs.reverse()
+    return pairs
+
+
+def resolve_path(root, path):
+    '''
+    return the element a path from Diff designates in the tree of root
+    '''
+    elem = None
+    for step in re.findall(r'/(?:\{[^}]*\})?[^/\[]+\[\d+\]', path):
+        candidates = [root] if elem is None else list(elem)
+        for child, child_step in zip(candidates, _path_steps(candidates)):
+            if child_step == step:
+                elem = child
+                break
+        else:
+            raise KeyError(path)
+    if elem is None:
+        raise KeyError(path)
+    return elem
+
+
+@contextlib.contextmanager
+def xmlsink(fp, compress=False):
+    '''
+    yield a function serializing elements to file object fp as they are
+    written out, compress is False, True or a gzip compression level
+    '''
+    if compress:
+        fp = gzip.GzipFile(fileobj=fp, mode='wb',
+                           compresslevel=9 if compress is True else compress)
+
+    def write(elem):
+        if len(elem) == 0: # cheaper than setting up a writer
+            fp.write(etree.tostring(elem))
+            return
+        # an xmlfile only takes one top level element
+        with etree.xmlfile(fp) as xf:
+            xf.write(elem)
+
+    try:
+        yield write
+    finally:
+        if compress:
+            fp.close()
+
+
+# lxml parsers must not be used by two threads at once, each thread gets
+# its own
+_parsers = threading.local()
+
+
+def make_parser(html=False, **options):
+    '''
+    return a parser shared by every call with the same options in the
+    calling thread, options are those of lxml.etree.XMLParser (huge_tree,
+    remove_blank_text, ...) or of lxml.etree.HTMLParser if html is true
+    '''
+    try:
+        parsers = _parsers.cache
+    except AttributeError:
+        parsers = _parsers.cache = {}
+    key = (html, tuple(sorted(options.items())))
+    if key not in parsers:
+        if html:
+            parsers[key] = etree.HTMLParser(**options)
+        else:
+            parsers[key] = etree.XMLParser(**options)
+    return parsers[key]
+
+
+class _BufferReader(object):
+    '''
+    file-like reader over a bytes buffer, lxml pulls it chunk by chunk
+    instead of requiring the whole document as one string
+    '''
+
+    def __init__(self, buf):
+        if isinstance(buf, bytearray):
+            buf = memoryview(buf)
+        self.buf = buf
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.buf)
+        if size >= 0:
+            end = min(end, self.pos + size)
+        chunk = self.buf[self.pos:end]
+        self.pos = end
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        return chunk
+
+
+class ElementIndex(object):
+    '''
+    map tag names, ids, classes and attribute names of a subtree to its
+    elements in document order
+
+    the index is only valid until its tree is modified, or until root is
+    moved to another tree
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.stamp = _stamp(root)
+        self.tags = defaultdict(list)
+        self.ids = defaultdict(list)
+        self.classes = defaultdict(list)
+        self.attrs = defaultdict(list)
+
+        for elem in root.iter(etree.Element):
+            self.tags[elem.tag].append(elem)
+            for name in elem.attrib:
+                self.attrs[name].append(elem)
+            value = elem.get('id')
+            if value:
+                self.ids[value].append(elem)
+            value = elem.get('class')
+            if value:
+                for name in set(value.split()):
+                    self.classes[name].append(elem)
+
+    def is_valid(self):
+        return self.stamp == _stamp(self.root)
+
+    @staticmethod
+    def has_key(elem, table, key):
+        if table == 'tags':
+            return elem.tag == key
+        if table == 'ids':
+            return elem.get('id') == key
+        if table == 'classes':
+            return key in (elem.get('class') or '').split()
+        return key in elem.attrib
+
+    def lookup(self, keys):
+        '''
+        elements that have all the keys, in document order
+        '''
+        found = min([ getattr(self, table).get(key, ()) for table, key in keys ],
+                    key=len)
+        return [ elem for elem in found
+                 if all([ self.has_key(elem, table, key)
+                          for table, key in keys ]) ]
+
+    def find(self, sel):
+        '''
+        elements matching CSS selector string, or None if the index can't
+        answer it
+        '''
+        kind, keys, check = plan_cache(sel)
+        if kind == 'scan':
+            return None
+
+        found = self.lookup(keys)
+        if kind == 'index':
+            if check is None:
+                return found
+            return [ elem for elem in found if check(elem) ]
+
+        outermost = []
+        for elem in found:
+            if not outermost or outermost[-1] not in elem.iterancestors():
+                outermost.append(elem)
+        match = selector_cache(sel)
+        return [ i for elem in outermost for i in match(elem) ]
+
+
+class Diff(object):
+    '''
+    differences between two trees, as found by XQuery.diff
+
+    removed: (path, node) of subtrees only in the left tree
+    inserted: (path, node) of subtrees only in the right tree
+    changed: (path, old, new) of leaves whose text differs
+    patch: operations that turn the left tree into the right one, to give
+    to XQuery.apply_patch, or None if the roots differ, which are then
+    reported as removed and inserted
+
+    paths of removed and changed nodes are in the left tree, paths of
+    inserted nodes in the right one
+    '''
+
+    def __init__(self):
+        self.removed = []
+        self.inserted = []
+        self.changed = []
+        self.patch = []
+
+    def __nonzero__(self):
+        return bool(self.removed or self.inserted or self.changed)
+
+    def __repr__(self):
+        return '<Diff removed=%d inserted=%d changed=%d>' % (
+            len(self.removed), len(self.inserted), len(self.changed))
+
 
 class XQuery(object):
 
-    def __init__(self, xml):
+    def __init__(self, xml, parser=None):
         '''
         create a XML node instance from XML string or lxml.etree Element
         '''
         if isinstance(xml, basestring):
-            self.root = etree.fromstring(xml)
+            self.root = etree.fromstring(xml, parser)
         else: # it's an etree Element
             self.root = xml
+        self._fingerprint = None
+        self._index = None
+
+    @classmethod
+    def from_file(cls, path, parser=None, **options):
+        '''
+        parse a file name or file object, the file is read by libxml2
+        directly. options build a shared parser, see make_parser()
+        '''
+        if parser is None and options:
+            parser = make_parser(**options)
+        return cls(etree.parse(path, parser).getroot())
+
+    @classmethod
+    def from_buffer(cls, buf, parser=None, **options):
+        '''
+        parse a bytes buffer (str, bytearray, memoryview, buffer, mmap...)
+        without copying it into one string first
+        '''
+        if parser is None and options:
+            parser = make_parser(**options)
+        if isinstance(buf, str):
+            return cls(etree.fromstring(buf, parser))
+        return cls(etree.parse(_BufferReader(buf), parser).getroot())
+
+    @classmethod
+    def from_mmap(cls, path, parser=None, **options):
+        '''
+        parse a file through a read-only memory map of it
+        '''
+        with open(path, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls.from_buffer(buf, parser, **options)
+        finally:
+            buf.close()
+
+    @classmethod
+    def stream(cls, source, sel, **options):
+        '''
+        parse file name or file object incrementally and yield a node for
+        each element that matches CSS selector string, in the order their
+        end tags are parsed
+
+        each element is matched against its ancestors and what is left of
+        its preceding siblings only. A yielded node is freed once the next
+        one is requested (clone it to keep it), and every other element as
+        soon as no enclosing element can match, so memory stays bounded by
+        the largest match instead of the document size. As a consequence
+        selectors that look at siblings (``+``, ``~``, ``:nth-child``,
+        ``:last-child``...) are not supported in this mode, nor are the
+        ones without a tag name that look at the content of the element
+        (``:contains``, ``:empty``...). extra keyword arguments are passed
+        to lxml.etree.iterparse
+        '''
+        test = test_cache(sel)
+        tags = _subject_tags(sel)
+
+        # whether each open element may still be yielded when it ends, its
+        # descendants are kept as long as one of them may
+        candidates = []
+        pending = 0
+        for event, elem in etree.iterparse(source, events=('start', 'end'),
+                                           **options):
+            if event == 'start':
+                if not pending:
+                    _drop_preceding(elem)
+                if tags is None:
+                    candidate = test(elem)
+                else:
+                    candidate = elem.tag in tags
+                candidates.append(candidate)
+                pending += candidate
+                continue
+
+            pending -= candidates.pop()
+            if (tags is None or elem.tag in tags) and test(elem):
+                yield cls(elem)
+
+            # an enclosing match will be yielded later, keep it intact
+            if pending:
+                continue
+            elem.clear()
+            _drop_preceding(elem)
 
     def find(self, sel):
         '''
         find node using CSS selector string
+
+        the query runs when the result is first used, so further finds on
+        the result are fused into a single XPath evaluation, or before the
+        next modification made through XQuery, whichever comes first
         '''
-        return Chain([ XQuery(i) for i in CSSSelector(sel)(self.root) ])
+        index = self.index()
+        if index is not None:
+            found = index.find(sel)
+            if found is not None:
+                return Chain([ XQuery(i) for i in found ])
+        return Chain._lazy([self.root], (sel,))
+
+    def build_index(self):
+        '''
+        index the elements of this node so that find() can answer simple
+        selectors without walking the tree. Any modification made through
+        XQuery drops the index, call build_index() again to restore it
+        '''
+        self._index = ElementIndex(self.root)
+        return self
+
+    def index(self):
+        if self._index is not None and not self._index.is_valid():
+            self._index = None
+        return self._index
+
+    def explain(self, sel):
+        '''
+        tell how find(sel) runs: 'index', 'subtree' or 'scan'
+        '''
+        if self.index() is None:
+            return 'scan'
+        return plan_cache(sel)[0]
 
     @staticmethod
     def is_etree_node_eq(left, right):
-        if left.tag != right.tag:
-            return False
-
-        left_len = len(left)
-        if left_len != len(right):
-            return False
-
-        if left_len == 0:
-            ret = left.text == right.text
-            if not ret and left.text in (None, '') and \
-                right.text in (None, ''):
-                ret = True
-            return ret
+        pairs = [(left, right)]
+        while pairs:
+            left, right = pairs.pop()
+            if left.tag != right.tag:
+                return False
 
-        rchildren = list(right)
-        for i, child in enumerate(list(left)):
-            if not XQuery.is_etree_node_eq(child, rchildren[i]):
+            left_len = len(left)
+            if left_len != len(right):
                 return False
+
+            if left_len == 0:
+                if left.text != right.text and not (
+                    left.text in (None, '') and right.text in (None, '')):
+                    return False
+            else:
+                pairs.extend(itertools.izip(left, right))
         return True
 
+    def fingerprint(self):
+        '''
+        structural digest of the node, cached until the next modification
+        '''
+        stamp = _stamp(self.root)
+        if self._fingerprint is None or self._fingerprint[0] != stamp:
+            self._fingerprint = (stamp, fingerprint(self.root))
+        return self._fingerprint[1]
+
     def __eq__(self, right):
         if isinstance(right, Chain):
             if len(right) != 1:
                 return False
             right = right[0]
-        return XQuery.is_etree_node_eq(self.root, right.root)
+        if not isinstance(right, XQuery):
+            return NotImplemented
+        return self.fingerprint() == right.fingerprint()
+
+    def __ne__(self, right):
+        ret = self.__eq__(right)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    def __hash__(self):
+        return hash(self.fingerprint())
 
     def dumps(self):
         return etree.tostring(self.root)
     
     def inner_dumps(self):
-        return ''.join([ etree.tostring(child) for child in self.root ])
+        fp = StringIO()
+        self.inner_dump(fp)
+        return fp.getvalue()
+
+    def dump(self, fp, compress=False):
+        '''
+        write what dumps() returns to file object fp as it is serialized
+        '''
+        with xmlsink(fp, compress) as write:
+            write(self.root)
+
+    def inner_dump(self, fp, compress=False):
+        '''
+        write what inner_dumps() returns to file object fp as it is
+        serialized
+        '''
+        with xmlsink(fp, compress) as write:
+            for child in self.root:
+                write(child)
 
     def clone(self):
-        return self.__class__(self.dumps())
+        root = copy.deepcopy(self.root)
+        root.tail = None
+        node = self.__class__(root)
+        if (self._fingerprint is not None
+                and self._fingerprint[0] == _stamp(self.root)):
+            node._fingerprint = (_stamp(root), self._fingerprint[1])
+        return node
 
     def remove(self, sel):
         '''
         remove elements that match CSS selector string
         return the elements deleted
         '''
+        force_pending(self.root)
         backup = []
         for i in self.find(sel):
             backup.append(i)
+            touch(i.root)
             i.root.getparent().remove(i.root)
         return Chain(backup)
 
     def append(self, xquery_node):
+        force_pending(self.root)
         self.root.append(xquery_node.clone().root)
+        touch(self.root)
         return self
 
     #FIXME: text is a property of etree Element
@@ -86,12 +827,140 @@ class XQuery(object):
         if value == '':
             self.clear()
         else:
+            force_pending(self.root)
             self.root.text = value
+            touch(self.root)
         return self
     
     def clear(self):
+        force_pending(self.root)
+        touch(self.root)
         return self.root.clear()
 
+    def diff(self, other):
+        '''
+        compare with another node under the rules of __eq__ and return a
+        Diff. Identical subtrees are skipped by their fingerprint, only the
+        children of differing elements are compared, aligned on the longest
+        run of identical children they have in common
+        '''
+        left_digests, right_digests = {}, {}
+        fingerprint(self.root, left_digests)
+        fingerprint(other.root, right_digests)
+
+        result = Diff()
+        root_path = _path_steps([self.root])[0]
+        if self.root.tag != other.root.tag:
+            result.removed.append((root_path, self))
+            result.inserted.append((_path_steps([other.root])[0], other))
+            result.patch = None
+            return result
+
+        # the last item tells if the pair is still patched in place, or
+        # only reported because an ancestor gets rebuilt
+        pairs = [(self.root, other.root, root_path, root_path, True)]
+        while pairs:
+            left, right, lpath, rpath, in_place = pairs.pop()
+            if left_digests[left] == right_digests[right]:
+                continue
+            patch = result.patch if in_place else []
+
+            lchildren, rchildren = list(left), list(right)
+            lsteps = [ lpath + i for i in _path_steps(lchildren) ]
+            rsteps = [ rpath + i for i in _path_steps(rchildren) ]
+
+            if not rchildren:
+                for child, path in zip(lchildren, lsteps):
+                    result.removed.append((path, XQuery(child)))
+                    patch.append(('remove', path))
+                old, new = left.text or '', right.text or ''
+                if old != new:
+                    result.changed.append((lpath, old, new))
+                patch.append(('text', lpath, new))
+                continue
+
+            # common prefix and suffix of identical children
+            size = min(len(lchildren), len(rchildren))
+            start = 0
+            while start < size and left_digests[lchildren[start]] == \
+                right_digests[rchildren[start]]:
+                start += 1
+            end = 0
+            while end < size - start and left_digests[lchildren[-1-end]] \
+                == right_digests[rchildren[-1-end]]:
+                end += 1
+
+            # identical children in between anchor the alignment, the
+            # others are paired up between anchors as long as their tags
+            # agree
+            lend, rend = len(lchildren) - end, len(rchildren) - end
+            anchors = _common_subsequence(
+                [ left_digests[i] for i in lchildren[start:lend] ],
+                [ right_digests[i] for i in rchildren[start:rend] ])
+            anchors = [ (start + i, start + j) for i, j in anchors ]
+            anchors.append((lend, rend))
+
+            # append only adds at the end: rebuild everything after the
+            # first child that can't be patched in place
+            cut = None
+            li = ri = start
+            for lnext, rnext in anchors:
+                while li < lnext and ri < rnext and \
+                    lchildren[li].tag == rchildren[ri].tag:
+                    pairs.append((lchildren[li], rchildren[ri], lsteps[li],
+                                  rsteps[ri], in_place and cut is None))
+                    li += 1
+                    ri += 1
+                if cut is None and (li < lnext or ri < rnext):
+                    cut = (li, ri)
+                for i in range(li, lnext):
+                    result.removed.append((lsteps[i], XQuery(lchildren[i])))
+                for i in range(ri, rnext):
+                    result.inserted.append((rsteps[i], XQuery(rchildren[i])))
+                li, ri = lnext + 1, rnext + 1
+
+            if cut is not None:
+                for path in lsteps[cut[0]:]:
+                    patch.append(('remove', path))
+                for child in rchildren[cut[1]:]:
+                    patch.append(('append', lpath, XQuery(child)))
+        return result
+
+    def apply_patch(self, patch):
+        '''
+        apply the patch of a Diff whose left tree is this node
+        '''
+        if patch is None:
+            raise ValueError('root elements differ, no patch possible')
+        force_pending(self.root)
+        targets = [ XQuery(resolve_path(self.root, op[1])) for op in patch ]
+        for op, target in zip(patch, targets):
+            if op[0] == 'remove':
+                touch(target.root)
+                target.root.getparent().remove(target.root)
+            elif op[0] == 'append':
+                target.append(op[2])
+            else:
+                target.text(op[2])
+        return self
+
+
+def _outermost(elems):
+    '''
+    return elems once each and without those inside another one of them,
+    a selector matches nothing inside an element that it doesn't match
+    inside its ancestor
+    '''
+    given = set(elems)
+    seen = set()
+    result = []
+    for i in elems:
+        if i in seen or any( a in given for a in i.iterancestors() ):
+            continue
+        seen.add(i)
+        result.append(i)
+    return result
+
 
 class ChainMetaClass(type):
 
@@ -103,17 +972,173 @@ class ChainMetaClass(type):
                 return Chain([ getattr(x, api)(*args, **kw) for x in self ])
             return wrapper
 
+        def make_forcing(api):
+            method = getattr(list, api)
+            def wrapper(self, *args, **kw):
+                args = [ i.force() if isinstance(i, Chain) else i
+                         for i in args ]
+                return method(self.force(), *args, **kw)
+            return wrapper
+
         attrs.update([(api, make_wrapper(api)) for api in ('dumps',
-            'append', 'text', 'clone', 'clear', 'inner_dumps')])
+            'text', 'clone', 'clear', 'inner_dumps')])
+
+        # lazy chains have to run their query before any list access
+        attrs.update([(api, make_forcing(api)) for api in ('__len__',
+            '__iter__', '__reversed__', '__contains__', '__getitem__',
+            '__getslice__', '__setitem__', '__setslice__', '__delitem__',
+            '__delslice__', '__eq__', '__ne__', '__lt__', '__le__', '__gt__',
+            '__ge__', '__add__', '__iadd__', '__mul__', '__rmul__',
+            '__imul__', '__repr__', 'extend', 'insert', 'pop', 'remove',
+            'index', 'count', 'reverse', 'sort') if api not in attrs])
 
         return type.__new__(mcs, name, bases, attrs)
 
 
 class Chain(list):
+    '''
+    list of XQuery nodes
+
+    a chain returned by find() is lazy: it only records its context nodes
+    and selectors, and consecutive finds are compiled into one XPath
+    expression that runs the first time the chain is used as a list
+
+    find() on a chain returns each matched node once, in document order,
+    even when nodes of the chain are inside one another, whether the chain
+    was used as a list before or not
+    '''
 
     __metaclass__ = ChainMetaClass
 
-    def find(self, *args, **kw):
+    _pending = None
+
+    @classmethod
+    def _lazy(cls, roots, sels):
+        chain = cls()
+        chain._pending = (roots, sels)
+        _pending_chains[id(chain)] = chain
+        return chain
+
+    def force(self):
+        if self._pending is not None:
+            roots, sels = self._pending
+            self._pending = None
+            _pending_chains.pop(id(self), None)
+            if len(sels) == 1:
+                match = selector_cache(sels[0])
+            else:
+                match = path_cache(sels)
+            list.extend(self, [ XQuery(i) for root in roots
+                                for i in match(root) ])
+        return self
+
+    def __hash__(self):
+        if len(self) == 1:
+            return hash(self[0])
+        return hash(tuple(self))
+
+    def append(self, xquery_node):
+        '''
+        append a copy of xquery_node to every node of the chain, the
+        template is prepared once and copied element by element
+        '''
+        targets = [ x.root for x in self ]
+        force_pending(*targets)
+        template = xquery_node.clone().root
+        for root in targets[1:]:
+            # lxml's __copy__ is a deep copy, minus copy.deepcopy's overhead
+            root.append(template.__copy__())
+        if targets:
+            targets[0].append(template)
+        for root in targets:
+            touch(root)
+
         if len(self) == 1:
-            return self[0].find(*args, **kw)
-        return Chain(itertools.chain(*[ x.find(*args, **kw) for x in self ]))
+            return self[0]
+        return Chain(self)
+
+    def dump(self, fp, compress=False):
+        '''
+        write every node of the chain to file object fp, one after another
+        '''
+        with xmlsink(fp, compress) as write:
+            for x in self:
+                write(x.root)
+
+    def inner_dump(self, fp, compress=False):
+        with xmlsink(fp, compress) as write:
+            for x in self:
+                for child in x.root:
+                    write(child)
+
+    def __radd__(self, left):
+        return left + list(self.force())
+
+    def find(self, sel):
+        if self._pending is not None:
+            roots, sels = self._pending
+            return Chain._lazy(roots, sels + (sel,))
+        return Chain._lazy(_outermost([ x.root for x in self ]), (sel,))
+
+
+_worker_state = {}
+
+
+def _init_worker(selectors, method):
+    selector_cache.warm(selectors)
+    _worker_state['selectors'] = selectors
+    _worker_state['method'] = method
+
+
+def _query_document(selectors, method, task):
+    i, doc = task
+    if re.match(r'\s*<', doc):
+        x = XQuery(doc)
+    else:
+        x = XQuery.from_file(doc)
+    return i, [ [ getattr(node, method)() for node in x.find(sel) ]
+                for sel in selectors ]
+
+
+def _map_document(task):
+    return _query_document(_worker_state['selectors'],
+                           _worker_state['method'], task)
+
+
+def map_documents(documents, selectors, workers=None, ordered=True,
+                  method='text', chunksize=64):
+    '''
+    run CSS selectors over many documents in a pool of worker processes
+
+    documents are XML strings or file names, only those are sent to the
+    workers, which parse them and send back plain values. For each
+    document yield (position, values) where values holds, for each
+    selector, the text() (or the result of method, e.g. 'dumps') of every
+    matched node. With ordered=False results come as soon as they are
+    ready. workers=0 runs everything in the calling process.
+    '''
+    selectors = list(selectors)
+    tasks = enumerate(documents)
+    if workers == 0:
+        selector_cache.warm(selectors)
+        return itertools.imap(
+            functools.partial(_query_document, selectors, method), tasks)
+    return _map_pool(tasks, selectors, method, workers, ordered, chunksize)
+
+
+def _map_pool(tasks, selectors, method, workers, ordered, chunksize):
+    pool = multiprocessing.Pool(workers, _init_worker, (selectors, method))
+    try:
+        if ordered:
+            results = pool.imap(_map_document, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_map_document, tasks, chunksize)
+        for result in results:
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()